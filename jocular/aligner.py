@@ -12,6 +12,7 @@ from loguru import logger
 
 from jocular.component import Component
 from jocular.settingsmanager import JSettings
+from jocular.utils import as_image
 from jocular.processing.starextraction import extract_stars
 
 
@@ -160,6 +161,7 @@ class Aligner(Component, JSettings):
             sub.fwhm = np.median(stars["fwhm"])
 
         sub.aligned = False
+        sub.warp_model = None
 
         # if enough stars, try to align
         if nstars > self.min_stars:
@@ -180,9 +182,8 @@ class Aligner(Component, JSettings):
                 )
 
                 if self.warp_model is not None:
-                    sub.image = warp(
-                        sub.image, self.warp_model, order=3, preserve_range=True
-                    )
+                    sub.warp_model = self.warp_model
+                    self.apply_warp(sub)
                     sub.aligned = True
 
         if sub.aligned:
@@ -201,6 +202,14 @@ class Aligner(Component, JSettings):
         )
 
 
+    def apply_warp(self, sub):
+        # apply sub's stored warp model (if any) to its image
+        if getattr(sub, "warp_model", None) is not None:
+            sub.image = as_image(warp(
+                sub.image, sub.warp_model, order=3, preserve_range=True
+            ))
+
+
 def register(stars, keystars, min_stars=None, warp_model=None):
     """Find a Euclidean transformation that matches stars
     against keystars, returning the warp model
@@ -0,0 +1,95 @@
+''' Offscreen rendering of subs to animated GIF or MP4. Frames are produced
+    one at a time from the processed images and streamed to the encoder,
+    which runs in a background thread.
+'''
+
+import shutil
+import subprocess
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+from loguru import logger
+
+from jocular.utils import block_mean
+
+
+animation_worker = ThreadPoolExecutor(max_workers=1)
+
+
+def ffmpeg_path():
+    return shutil.which('ffmpeg')
+
+
+def to_frame(im, binfac=1, invert=False, flip_UD=False, flip_LR=False):
+    ''' Convert image in range 0-1 to uint8 frame as seen on screen, binned
+        by binfac; rows are reversed as display textures start at the bottom
+    '''
+    im = block_mean(im, binfac)
+    frame = np.clip(im * 255, 0, 255).astype(np.uint8)
+    if invert and frame.ndim == 2:
+        frame = 255 - frame
+    frame = frame if flip_UD else frame[::-1]
+    if flip_LR:
+        frame = frame[:, ::-1]
+    return np.ascontiguousarray(frame)
+
+
+def write_gif(frames, path, fps):
+    frames = (Image.fromarray(f) for f in frames)
+    first = next(frames)
+    # PIL gathers all frames before writing a gif, so unlike mp4 the (binned)
+    # frames are all held in memory until encoding finishes
+    first.save(path,
+        save_all=True,
+        append_images=frames,
+        optimize=True,
+        duration=1000 / fps,
+        loop=0)
+
+
+def write_mp4(frames, path, fps):
+    proc = None
+    try:
+        for frame in frames:
+            if proc is None:
+                h, w = frame.shape[:2]
+                proc = subprocess.Popen([
+                    ffmpeg_path(), '-y', '-loglevel', 'error',
+                    '-f', 'rawvideo', '-pix_fmt', 'gray' if frame.ndim == 2 else 'rgb24',
+                    '-s', f'{w}x{h}', '-r', f'{fps:.2f}', '-i', '-',
+                    '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+                    '-c:v', 'libx264', '-pix_fmt', 'yuv420p', path],
+                    stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+            proc.stdin.write(frame.tobytes())
+    finally:
+        if proc is not None:
+            proc.stdin.close()
+            err = proc.stderr.read().decode(errors='ignore')
+            if proc.wait() != 0:
+                raise Exception(f'ffmpeg failed ({err.strip()})')
+
+
+def write_animation(frames, path, fmt='gif', fps=2):
+    ''' Encode iterable of uint8 frames to path, returning path
+    '''
+    frames = iter(frames)
+    first = next(frames, None)
+    if first is None:
+        raise ValueError('no frames to animate')
+    frames = itertools.chain([first], frames)
+    if fmt == 'mp4':
+        write_mp4(frames, path, fps)
+    else:
+        write_gif(frames, path, fps)
+    logger.info(f'saved animation to {path}')
+    return path
+
+
+def save_animation(frames, path, fmt='gif', fps=2, on_done=None):
+    ''' Encode frames in the background; on_done is called with the future
+    '''
+    future = animation_worker.submit(write_animation, frames, path, fmt=fmt, fps=fps)
+    if on_done is not None:
+        future.add_done_callback(on_done)
+    return future
@@ -1,8 +1,9 @@
 """ Multi-frame bad pixel map
 """
 
+import os
+import json
 import numpy as np
-from scipy.ndimage import convolve
 from loguru import logger
 
 from kivy.app import App
@@ -17,6 +18,10 @@ class BadPixelMap(Component, JSettings):
     apply_BPM = BooleanProperty(True)
     sigmas = NumericProperty(5)
     bpm_frames = NumericProperty(3)
+    use_stored_BPM = BooleanProperty(True)
+    redetect_interval = NumericProperty(10)
+    redetect_temperature = NumericProperty(2)
+    stats_stride = 2
 
     tab_name = "Bad pixel map"
     configurables = [
@@ -44,18 +49,132 @@ class BadPixelMap(Component, JSettings):
                 "fmt": "{:.0f} sigmas",
             },
         ),
+        (
+            "use_stored_BPM",
+            {
+                "name": "reuse map across sessions?",
+                "switch": "",
+                "help": "Start each object with the map learned previously for this camera, binning and ROI",
+            },
+        ),
+        (
+            "redetect_interval",
+            {
+                "name": "redetect hot pixels every",
+                "float": (1, 50, 1),
+                "help": "Once a map is available, only search for hot pixels this often",
+                "fmt": "{:.0f} subs",
+            },
+        ),
+        (
+            "redetect_temperature",
+            {
+                "name": "redetect on temperature change",
+                "float": (1, 10, 1),
+                "help": "Search for hot pixels whenever sensor temperature changes by this much",
+                "fmt": "{:.0f} degrees",
+            },
+        ),
     ]
 
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.app = App.get_running_app()
+        self.maps_path = self.app.get_path('bad_pixel_maps.json')
+        self.stored_maps = self.load_maps()
+        self.maps_changed = False
+        self.buffers = None
 
 
     def on_new_object(self, *args):
+        self.save_maps()
         self.bpm = None
         self.bplist = []
         self.frame_count = 0
+        self.map_key = None
+        self.seeded = False
+        self.seed = None  # most recent stored map for this camera, if any
+        self.subs_since_detection = 0
+        self.detection_temperature = None
+
+
+    def on_close(self, *args):
+        self.save_maps()
+
+
+    def load_maps(self):
+        ''' Maps are stored as lists of (row, col) keyed by camera,
+            binning and ROI
+        '''
+        if not os.path.exists(self.maps_path):
+            return {}
+        try:
+            with open(self.maps_path, 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error(f'Problem reading bad pixel maps {self.maps_path} ({e})')
+            return {}
+
+
+    def save_maps(self):
+        if not self.maps_changed:
+            return
+        try:
+            with open(self.maps_path, 'w') as f:
+                json.dump(self.stored_maps, f)
+            self.maps_changed = False
+        except Exception as e:
+            logger.error(f'Problem saving bad pixel maps {self.maps_path} ({e})')
+
+
+    def get_map_key(self, sub):
+        ''' Defects are specific to a camera, binning and sensor region
+        '''
+        camera = 'unknown' if sub.camera is None else sub.camera
+        x0 = 0 if sub.ROI_x is None else sub.ROI_x
+        y0 = 0 if sub.ROI_y is None else sub.ROI_y
+        return f'{camera} | bin {sub.binning} | {x0},{y0} {sub.shape_str}'
+
+
+    def seed_bpm(self, sub):
+        ''' Start from the map learned for this camera in a previous session
+        '''
+        self.map_key = self.get_map_key(sub)
+        stored = self.stored_maps.get(self.map_key, None)
+        if stored is None:
+            return
+        self.seed = {(r, c) for r, c in stored['pixels']}
+        self.bpm = set(self.seed)
+        self.seeded = True
+        self.detection_temperature = stored.get('temperature', None)
+        logger.debug(f'seeded with {len(self.bpm)} stored pix for {self.map_key}')
+
+
+    def store_bpm(self, sub):
+        if self.bpm is None or self.map_key is None:
+            return
+        self.stored_maps[self.map_key] = {
+            'temperature': sub.temperature,
+            'pixels': [[int(r), int(c)] for r, c in self.bpm]
+        }
+        self.maps_changed = True
+
+
+    def detection_due(self, sub):
+        ''' Search for hot pixels while the map is being learned and then
+            only periodically or when the temperature changes
+        '''
+        if not self.use_stored_BPM:
+            return True
+        if not self.seeded and len(self.bplist) < self.bpm_frames:
+            return True
+        if self.subs_since_detection >= self.redetect_interval - 1:
+            return True
+        t, t0 = sub.temperature, self.detection_temperature
+        if t is not None and t0 is not None and abs(t - t0) >= self.redetect_temperature:
+            return True
+        return False
 
 
     def process_bpm(self, sub):
@@ -66,47 +185,82 @@ class BadPixelMap(Component, JSettings):
             return
 
         im = sub.get_image()
-        badpix = self.find_hot_pixels(im)
 
-        # only update map if it is a light sub
+        # only update map if it is a light sub
         if sub.sub_type == 'light':
-            self.update_bpm(badpix)
-            if self.bpm is not None:
-                logger.debug(f'{len(badpix)} pix, {len(self.bpm)} in map')
+            if self.map_key is None and self.use_stored_BPM:
+                self.seed_bpm(sub)
+            if self.detection_due(sub):
+                badpix = self.find_hot_pixels(im)
+                self.update_bpm(badpix)
+                self.subs_since_detection = 0
+                self.detection_temperature = sub.temperature
+                if self.use_stored_BPM and (self.seeded or len(self.bplist) == self.bpm_frames):
+                    self.store_bpm(sub)
+                if self.bpm is not None:
+                    logger.debug(f'{len(badpix)} pix, {len(self.bpm)} in map')
+            else:
+                self.subs_since_detection += 1
         self.do_bpm(im, self.bpm)
 
 
     def find_hot_pixels(self, im):
         """Return hot pixel candidates.
-        Look for non-edge pixels whose intensity is significantly greater
-        than their neighbours. Approach is conservative in order to
-        find all hot pixels, since for EAA the only adverse effect is to
-        replace a few non-hot pixels by their median. Returns a set of (row, col)
-        coordinates.
-
-        10ms for Lodestar, 50ms for ASI 290MM
+        Look for non-edge pixels that are brighter than all of their 8
+        neighbours, and whose contrast with the brightest neighbour is
+        an outlier. Returns a set of (row, col) coordinates.
+
+        Unlike the earlier ratio-to-local-sum detector, this finds isolated
+        hot pixels only: in an adjacent pair (or larger cluster) each pixel
+        is compared with a hot neighbour, so none is reported. Since the
+        threshold statistics come from a strided sample of the contrasts,
+        results also differ slightly for isolated pixels.
+
+        Neighbour maxima are computed separably (rows then columns) in
+        float32 buffers that are reused from sub to sub.
         """
 
-        # set min to zero
-        im_norm = im - np.min(im)
+        h, w = im.shape
+        lr, m3, nbr, denom = self.get_buffers(h, w)
 
-        # divide im by local sum in 3x3 region
-        im2 = im_norm / convolve(im_norm, np.ones((3, 3)), mode="constant")
+        # max of left and right neighbours, then horizontal max over 3 pixels
+        np.maximum(im[:, :-2], im[:, 2:], out=lr)
+        np.maximum(lr, im[:, 1:-1], out=m3)
 
-        # Define hot pix as more than 'sigmas' SD from mean
-        hp_cands = im2 > np.mean(im2) + self.sigmas * np.std(im2)
+        # max over 8-neighbourhood: rows above and below plus left/right
+        np.maximum(m3[:-2], m3[2:], out=nbr)
+        np.maximum(nbr, lr[1:-1], out=nbr)
 
-        # set boundaries to zero
-        hp_cands[0, :] = 0
-        hp_cands[-1, :] = 0
-        hp_cands[:, 0] = 0
-        hp_cands[:, -1] = 0
+        # contrast between pixel and brightest neighbour (after setting min to zero)
+        centre = im[1:-1, 1:-1]
+        np.add(centre, nbr, out=denom)
+        denom -= 2 * np.min(im) - 1e-6
+        np.subtract(centre, nbr, out=nbr)
+        np.divide(nbr, denom, out=nbr)
 
-        # coordinates of hot pixels as 2 x N array
-        hps = np.where(hp_cands > 0)
+        # Define hot pix as more than 'sigmas' SD from mean of sampled contrasts
+        step = self.stats_stride
+        sample = nbr[::step, ::step]
+        thresh = max(0, np.mean(sample) + self.sigmas * np.std(sample))
 
-        return set(zip(hps[0], hps[1]))
-        # return {(r, c) for r, c in zip(hps[0], hps[1])}
+        # coordinates of hot pixels (offset by 1 since edges are excluded)
+        rows, cols = np.nonzero(nbr > thresh)
+
+        return set(zip(rows + 1, cols + 1))
+
+
+    def get_buffers(self, h, w):
+        ''' Working buffers for hot pixel detection, reallocated only
+            when the image shape changes
+        '''
+        if self.buffers is None or self.buffers[0].shape != (h, w - 2):
+            self.buffers = (
+                np.empty((h, w - 2), dtype=np.float32),
+                np.empty((h, w - 2), dtype=np.float32),
+                np.empty((h - 2, w - 2), dtype=np.float32),
+                np.empty((h - 2, w - 2), dtype=np.float32)
+            )
+        return self.buffers
 
 
     def do_bpm(self, im, bpm=None):
@@ -121,18 +275,21 @@ class BadPixelMap(Component, JSettings):
 
     def compute_bpm(self):
         # Use intersection of bad pixels from previous N frames to compute bad pixel map
+        # Any seed is kept out of the intersection (so new hot pixels are picked
+        # up at once) and added to the map until N frames have been seen
         if self.bplist:
             self.bpm = self.bplist[0]
             for bpl in self.bplist[1:]:
                 self.bpm = self.bpm.intersection(bpl)
+            if self.seed is not None and len(self.bplist) < self.bpm_frames:
+                self.bpm = self.bpm.union(self.seed)
 
 
     def update_bpm(self, bpm):
         # Add new BPM set to BPM, recomputing BPM
-        if len(self.bplist) == self.bpm_frames:
-            self.bplist[self.frame_count % self.bpm_frames] = bpm
-        else:
-            self.bplist.append(bpm)
+        # oldest set is dropped once bpm_frames are held
+        self.bplist.append(bpm)
+        del self.bplist[:-int(self.bpm_frames)]
         self.frame_count += 1
         self.compute_bpm()
         
@@ -2,10 +2,15 @@
 '''
 
 import os.path
+import math
 import numpy as np
+from types import SimpleNamespace
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from loguru import logger
 
 from kivy.app import App
+from kivy.clock import Clock
 from kivy.properties import (
     BooleanProperty, DictProperty, 
     NumericProperty, StringProperty
@@ -13,7 +18,7 @@ from kivy.properties import (
 from kivy.core.window import Window
 
 from jocular.table import Table
-from jocular.utils import make_unique_filename, toast, percentile_clip
+from jocular.utils import make_unique_filename, toast, percentile_clip, check_dtype
 from jocular.component import Component
 from jocular.settingsmanager import JSettings
 from jocular.image import Image, save_image, fits_in_dir
@@ -22,6 +27,10 @@ from jocular.gradient import estimate_background
 
 date_time_format = '%d %b %y %H:%M'
 
+# sub properties used to select masters
+matching_props = ['camera', 'gain', 'offset', 'binning', 'exposure', 'filter',
+    'shape', 'ROI_x', 'ROI_y', 'ROI_w', 'ROI_h']
+
 
 def none_to_empty(x):
     return '' if x is None else x
@@ -66,6 +75,33 @@ def subregion(m, s):
     return None
 
 
+def fit_dark_scale(im, dark, bias=None, pedestal=True, npts=20000):
+    ''' Least-squares estimate of the factor k by which to scale the
+        thermal component of dark to match im, fitted as im = k * dark + c
+        (c is omitted if pedestal is False) over a random sample of pixels.
+        Brightest pixels in im (stars) and in dark (hot pixels, which
+        may already have been removed from im) are excluded from the fit.
+        Returns None if the fit is not possible.
+    '''
+
+    inds = np.random.randint(0, im.size, size=npts)
+    y = im.ravel()[inds]
+    x = dark.ravel()[inds]
+    if bias is not None:
+        b = bias.ravel()[inds]
+        y = y - b
+        x = x - b
+
+    keep = (y < np.percentile(y, 95)) & (x < np.percentile(x, 99))
+    x, y = x[keep], y[keep]
+    if len(x) < 100 or np.std(x) == 0:
+        return None
+
+    A = np.stack([x, np.ones(len(x), dtype=x.dtype)], axis=1) if pedestal else x[:, np.newaxis]
+    coefs = np.linalg.lstsq(A, y, rcond=None)[0]
+    return float(coefs[0])
+
+
 class Calibrator(Component, JSettings):
 
     save_settings = ['apply_dark', 'apply_flat']
@@ -73,6 +109,8 @@ class Calibrator(Component, JSettings):
     masters = DictProperty({})
     apply_flat = BooleanProperty(False)
     apply_dark = BooleanProperty(False)
+    scale_darks = BooleanProperty(False)
+    dark_pedestal = BooleanProperty(True)
     use_l_filter = BooleanProperty(True)
     remove_hot_pixels = BooleanProperty(True)
     fd_exposure_tol = NumericProperty(.1)
@@ -106,6 +144,16 @@ class Calibrator(Component, JSettings):
             'fmt': '{:.0f} seconds',
             'help': 'When selecting a dark, select those within this exposure tolerance'
             }),
+        ('scale_darks', {
+            'name': 'scale darks?',
+            'switch': '',
+            'help': 'If no dark is within exposure tolerance, scale the closest one to match each sub'
+            }),
+        ('dark_pedestal', {
+            'name': 'fit pedestal when scaling?',
+            'switch': '',
+            'help': 'Allow for a constant offset (e.g. sky or bias level) when fitting the dark scale'
+            }),
         ('temperature_tol', {
             'name': 'temperature tolerance', 
             'float': (0, 40, 1),
@@ -126,12 +174,17 @@ class Calibrator(Component, JSettings):
 
 
     def __init__(self, **kwargs):
+        # created first in case apply_dark/flat are set during initialisation
+        self.recalibrate_trigger = Clock.create_trigger(self.recalibrate_stack)
         super().__init__(**kwargs)
         self.app = App.get_running_app()
         self.calibration_dir = self.app.get_path('calibration')
 
         self.masters = {}   # map from name to FITs Image instance
         self.library = {}   # map from name to calibration table info
+        self.pinned = {}    # map from name to preloaded float32 image
+        self.preload_worker = ThreadPoolExecutor(max_workers=1)
+        self.last_sub = None    # props of most recently calibrated sub
  
         ''' construct above dicts from calibration FITs in calibration directory
         '''
@@ -145,12 +198,134 @@ class Calibrator(Component, JSettings):
                 logger.warning(f'Calibrator: unable to parse calibration {f} ({e})')
 
 
+    def on_apply_dark(self, *args):
+        self.recalibrate_trigger()
+
+
+    def on_apply_flat(self, *args):
+        self.recalibrate_trigger()
+
+
+    def recalibrate_stack(self, *args):
+        ''' Masters or their use have changed so reapply to current stack
+        '''
+        if Component.is_loaded('Stacker'):
+            stacker = Component.get('Stacker')
+            # without raw subs this would mean reloading and realigning
+            if stacker.keep_raw_subs:
+                stacker.recalibrate()
+
+
     def on_new_object(self, *args):
         n_masters = len(self.library)
         if n_masters > 0:
             self.info(f'{n_masters:d} masters')
         else:
             self.info('no masters')
+        self.preload_masters(self.predict_masters())
+
+
+    def predicted_subs(self):
+        ''' Generate the likely properties of subs for the coming object, based
+            on the last calibrated sub updated with the current camera state,
+            and with exposure/filter from the light capture scripts
+        '''
+
+        props = dict(self.last_sub) if self.last_sub is not None else {}
+
+        try:
+            capture_props = Component.get('Camera').get_capture_props()
+        except Exception as e:
+            logger.debug(f'cannot get camera props ({e})')
+            capture_props = None
+        if capture_props is not None:
+            props.update({k: v for k, v in capture_props.items() if k in matching_props})
+            if props.get('ROI_w') is not None and props.get('ROI_h') is not None:
+                props['shape'] = (props['ROI_w'], props['ROI_h'])
+
+        # can't select masters without knowing the sub shape
+        if props.get('shape') is None:
+            return []
+
+        expo_filts = set()
+        if props.get('exposure') is not None:
+            expo_filts.add((props['exposure'], props.get('filter')))
+        try:
+            scripts = Component.get('CaptureScript').scripts
+            for s in ['light', 'seq']:
+                for f in scripts[s]['filter']:
+                    expo_filts.add((scripts[s]['exposure'], f))
+        except Exception as e:
+            logger.debug(f'cannot get capture script details ({e})')
+
+        subs = []
+        for expo, filt in expo_filts:
+            sub = SimpleNamespace(**{k: props.get(k) for k in matching_props})
+            sub.exposure, sub.filter = expo, filt
+            subs.append(sub)
+        return subs
+
+
+    def predict_masters(self):
+        ''' Names of masters that calibrate is likely to use for coming subs
+        '''
+
+        if len(self.library) == 0 or not (self.apply_dark or self.apply_flat):
+            return set()
+
+        names = set()
+        for sub in self.predicted_subs():
+            try:
+                dark = self.get_dark(sub)
+                if dark is None and self.apply_dark and self.scale_darks:
+                    dark = self.get_scalable_dark(sub)
+                names |= {dark, self.get_flat(sub), self.get_bias(sub)}
+            except Exception as e:
+                logger.debug(f'cannot predict masters for {sub} ({e})')
+        names.discard(None)
+        return names
+
+
+    def preload_masters(self, names):
+        ''' Load predicted masters in a background thread and pin them so
+            that the first sub is calibrated without reading any FITs
+        '''
+
+        self.pinned = {k: v for k, v in self.pinned.items() if k in names}
+        to_load = [n for n in names if n not in self.pinned]
+        if len(to_load) == 0:
+            return
+        logger.debug(f'preloading masters {to_load}')
+        future = self.preload_worker.submit(partial(self.load_masters, to_load))
+        future.add_done_callback(self.masters_loaded)
+
+
+    def load_masters(self, names):
+        ''' Runs in background thread
+        '''
+        loaded = {}
+        for n in names:
+            im = self.masters[n].get_image()
+            if im is not None:
+                loaded[n] = im.astype(np.float32, copy=False)
+        return loaded
+
+
+    def masters_loaded(self, future):
+        ''' Pin loaded masters on the main thread
+        '''
+        try:
+            loaded = future.result()
+        except Exception as e:
+            logger.warning(f'problem preloading masters ({e})')
+            return
+        Clock.schedule_once(partial(self.pin_masters, loaded), 0)
+
+
+    def pin_masters(self, loaded, *args):
+        # ignore any that have been deleted in the meantime
+        self.pinned.update({k: v for k, v in loaded.items() if k in self.masters})
+        logger.debug(f'pinned {len(loaded)} masters')
 
 
     def add_to_library(self, m):
@@ -233,6 +408,7 @@ class Calibrator(Component, JSettings):
 
         save_image(data=data, path=path, capture_props=capture_props)
         self.add_to_library(Image(path))
+        self.recalibrate_trigger()
 
         # add to notes field of current DSO
         notes = f'Exposure {exp_to_str(capture_props.get("exposure", 0))}\n'
@@ -251,6 +427,7 @@ class Calibrator(Component, JSettings):
         '''
 
         sub.calibrations = set({})
+        self.last_sub = {k: getattr(sub, k, None) for k in matching_props}
 
         if len(self.library) == 0:
             self.info('no masters')
@@ -262,36 +439,85 @@ class Calibrator(Component, JSettings):
 
         logger.trace('starting calibration')
 
+        plan = self.select_masters(sub)
+        sub.image = self.apply_masters(sub.get_image(), [sub], plan)
+        sub.calibrations = set(plan['calibrations'])
+
+        logger.trace('calibration complete')
+
+        applied = ' '.join(list(sub.calibrations))
+        if applied and plan['scale_dark'] and 'dark' in sub.calibrations:
+            self.info(f'{applied} (dark x{sub.dark_scale:.2f})')
+        elif applied:
+            self.info(applied)
+        else:
+            self.info('none suitable')
+
+
+    def calibrate_batch(self, subs, batch_size=16):
+        ''' Recalibrate light subs from their stored raw images (sub.raw_image),
+            e.g. when masters have changed. Subs sharing the same masters and
+            geometry are calibrated together in a single vectorised pass.
+        '''
+
+        for sub in subs:
+            sub.calibrations = set({})
+
+        if len(self.library) == 0 or not (self.apply_dark or self.apply_flat):
+            # copy as bad pixel removal etc may modify sub images in place
+            for sub in subs:
+                sub.image = sub.raw_image.copy()
+            self.info('none' if len(self.library) > 0 else 'no masters')
+            return
+
+        # group subs by masters and geometry
+        groups = {}
+        for sub in subs:
+            plan = self.select_masters(sub)
+            key = (plan['dark'], plan['flat'], plan['bias'], plan['scale_dark'],
+                frozenset(plan['calibrations']), sub.ROI_x, sub.ROI_y, sub.raw_image.shape)
+            groups.setdefault(key, (plan, []))[1].append(sub)
+
+        for plan, group in groups.values():
+            for i in range(0, len(group), batch_size):
+                batch = group[i: i + batch_size]
+                ims = self.apply_masters(np.stack([s.raw_image for s in batch]), batch, plan)
+                for sub, im in zip(batch, ims):
+                    sub.image = im
+                    sub.calibrations = set(plan['calibrations'])
+
+        ncal = len([s for s in subs if s.calibrations])
+        self.info(f'recalibrated {ncal}/{len(subs)} subs')
+        logger.debug(f'recalibrated {len(subs)} subs in {len(groups)} groups')
+
+
+    def select_masters(self, sub):
+        ''' Choose masters for sub and determine which calibrations they allow
+        '''
+
         # get all masters anyway (~1ms)
         dark = self.get_dark(sub)
         flat = self.get_flat(sub)
         bias = self.get_bias(sub)
-        
-        logger.trace(f'D {dark} F {flat} B {bias}')
 
-        D = self.get_master(dark)
-        F = self.get_master(flat)
-        B = self.get_master(bias)
+        # if no dark within tolerance, look for one we can scale
+        scale_dark = dark is None and self.apply_dark and self.scale_darks
+        if scale_dark:
+            dark = self.get_scalable_dark(sub)
 
-        im = sub.get_image()
+        logger.trace(f'D {dark} F {flat} B {bias}')
 
         # to apply dark we just need a dark
+        calibrations = set({})
         if self.apply_dark and dark is not None:
-            dx0, dx1, dy0, dy1 = subregion(self.masters[dark], sub)
-            logger.trace(f'Dark subregion {dx0} {dx1} {dy0} {dy1}')
-            im = im - D[dy0: dy1, dx0: dx1]
-            sub.calibrations = {'dark'}
+            calibrations = {'dark'}
 
         # to apply flat we need a flat and either a bias or a dark
         if self.apply_flat and flat is not None:
-            fx0, fx1, fy0, fy1 = subregion(self.masters[flat], sub)
-            if 'dark' in sub.calibrations:
-                im = im / F[fy0: fy1, fx0: fx1]
-                sub.calibrations = {'dark', 'flat'}
+            if 'dark' in calibrations:
+                calibrations = {'dark', 'flat'}
             elif bias is not None:
-                bx0, bx1, by0, by1 = subregion(self.masters[bias], sub)
-                im = (im - B[by0: by1, bx0: bx1]) / F[fy0: fy1, fx0: fx1]
-                sub.calibrations = {'bias', 'flat'}
+                calibrations = {'bias', 'flat'}
             # else:
             #     # manufacture a constant dark using background
             #     mean_back, std_back = estimate_background(im)
@@ -299,25 +525,75 @@ class Calibrator(Component, JSettings):
             #     im = ((im - offset) / F)  + offset
             #     sub.calibrations = {'syn-dark', 'flat'}
 
+        return {'dark': dark, 'flat': flat, 'bias': bias,
+            'scale_dark': scale_dark, 'calibrations': calibrations}
+
+
+    def apply_masters(self, im, subs, plan):
+        ''' Apply calibrations in plan to im, which is either a single image
+            or a stack of images with one per sub along the first axis; subs
+            must share the same geometry. Masters broadcast over the stack.
+        '''
+
+        calibrations = plan['calibrations']
+        dark, flat, bias = plan['dark'], plan['flat'], plan['bias']
+        sub = subs[0]
+
+        if 'dark' in calibrations:
+            dx0, dx1, dy0, dy1 = subregion(self.masters[dark], sub)
+            logger.trace(f'Dark subregion {dx0} {dx1} {dy0} {dy1}')
+            D = self.get_master(dark)[dy0: dy1, dx0: dx1]
+            if plan['scale_dark']:
+                if im.ndim == 3:
+                    D = np.stack([self.scaled_dark(i, D, s, dark, bias) for i, s in zip(im, subs)])
+                else:
+                    D = self.scaled_dark(im, D, sub, dark, bias)
+            im = im - D
+
+        if 'flat' in calibrations:
+            fx0, fx1, fy0, fy1 = subregion(self.masters[flat], sub)
+            F = self.get_master(flat)[fy0: fy1, fx0: fx1]
+            if 'dark' in calibrations:
+                im = im / F
+            else:
+                bx0, bx1, by0, by1 = subregion(self.masters[bias], sub)
+                B = self.get_master(bias)
+                im = (im - B[by0: by1, bx0: bx1]) / F
+
         # restore background to avoid clipping in next step 
-        if 'bias' in sub.calibrations:
-            im = im + np.mean(B)
-        elif 'dark' in sub.calibrations:
-            im = im + np.mean(D)
+        if 'bias' in calibrations:
+            im = im + np.mean(B, dtype=np.float32)
+        elif 'dark' in calibrations:
+            im = im + np.mean(D, axis=(-2, -1), keepdims=True, dtype=np.float32)
 
         # limit
         im[im < 0] = 0
         im[im > 1] = 1
 
-        sub.image = im
+        return check_dtype(im, 'calibration')
 
-        logger.trace('calibration complete')
 
-        applied = ' '.join(list(sub.calibrations))
-        if applied:
-            self.info(applied)
-        else:
-            self.info('none suitable')
+    def scaled_dark(self, im, D, sub, dark, bias=None):
+        ''' Scale thermal component of dark D to match sub, falling back to
+            the ratio of exposures if the fit fails or is implausible
+        '''
+
+        B = None
+        if bias is not None:
+            bx0, bx1, by0, by1 = subregion(self.masters[bias], sub)
+            B = self.get_master(bias)[by0: by1, bx0: bx1]
+
+        ratio = sub.exposure / self.masters[dark].exposure
+        k = fit_dark_scale(im, D, bias=B, pedestal=self.dark_pedestal)
+        if k is None or k < ratio / 4 or k > ratio * 4:
+            logger.debug(f'dark scale fit {k} implausible; using exposure ratio {ratio:.3f}')
+            k = ratio
+        sub.dark_scale = k
+        k = np.float32(k)
+
+        if B is None:
+            return k * D
+        return B + k * (D - B)
 
 
     def get_dark(self, sub, exposure_tol=None):
@@ -326,8 +602,29 @@ class Calibrator(Component, JSettings):
             NB for backwards compat, don't enforce camera if sub doesn't have one
         '''
 
-        if sub.exposure is None:
+        darks = self.matching_darks(sub, exposure_tol=exposure_tol)
+
+        # if we have darks, return name of first one
+        return darks[0] if len(darks) > 0 else None
+
+
+    def get_scalable_dark(self, sub):
+        ''' find dark with closest exposure, regardless of exposure tolerance
+        '''
+
+        darks = self.matching_darks(sub, exposure_tol=math.inf)
+        darks = [d for d in darks if self.masters[d].exposure > 0]
+        if len(darks) == 0:
             return None
+        return min(darks, key=lambda d: abs(self.masters[d].exposure - sub.exposure))
+
+
+    def matching_darks(self, sub, exposure_tol=None):
+        ''' return names of all darks that are compatible with sub
+        '''
+
+        if sub.exposure is None:
+            return []
 
         if exposure_tol is None:
             exposure_tol = self.exposure_tol
@@ -360,7 +657,7 @@ class Calibrator(Component, JSettings):
                         v.offset == (sub.offset if v.offset is not None else v.offset) and
                         # v.camera == (sub.camera if v.camera is not None else v.camera) and
                         v.exposure is not None and
-                        abs(v.exposure - sub.exposure) <= self.exposure_tol
+                        abs(v.exposure - sub.exposure) <= exposure_tol
                 }
                     
         temperature = Component.get('Session').temperature
@@ -373,22 +670,18 @@ class Calibrator(Component, JSettings):
             # find those within date tolerance (set to 1 to get darks in current session)
             darks = [k for k, v in darks.items() if v.age < self.dark_days_tol]
 
-        # if we have darks, return name of first one
-        return darks[0] if len(darks) > 0 else None
+        return darks
 
 
     def get_flatdark(self, sub):
         ''' simply a dark within flat-dark exposure tolerance
         '''
-        darks = self.get_dark(sub, exposure_tol=self.fd_exposure_tol)
-        if len(darks) == 0:
+        dark = self.get_dark(sub, exposure_tol=self.fd_exposure_tol)
+        if dark is None:
             logger.debug('no matching flatdark')
-            return None
-
-        # find the one with the closest exposure
-        for k in sorted(darks, key=darks.get):
-            logger.debug(f'matching flatdark {k}')
-            return k
+        else:
+            logger.debug(f'matching flatdark {dark}')
+        return dark
 
 
     def get_bias(self, sub):
@@ -445,6 +738,8 @@ class Calibrator(Component, JSettings):
     def get_master(self, name):
         if name is None:
             return None
+        if name in self.pinned:
+            return self.pinned[name]
         # Retrieve image (NB loaded on demand, so effectively a cache)
         return self.masters[name].get_image()
 
@@ -569,5 +864,6 @@ class Calibrator(Component, JSettings):
                 objio.delete_file(os.path.join(self.calibration_dir, nm))
                 del self.library[nm]
                 del self.masters[nm]
+                self.pinned.pop(nm, None)
         logger.info(f'deleted {len(self.calibration_table.selected)} calibration masters')
         self.calibration_table.update()
@@ -10,6 +10,7 @@ from kivy.clock import Clock
 
 from jocular.ascom import connect_to_ASCOM_device
 from jocular.cameras.genericcamera import GenericCamera
+from jocular.utils import from_adu
 
 
 class ASCOMCamera(GenericCamera):
@@ -88,7 +89,7 @@ class ASCOMCamera(GenericCamera):
 	def get_camera_data(self):
 		# data is ready so get it, convert to correct size, and scale to range 0-1
 		# assumes 16 bits for now
-		im = np.array(self.camera.ImageArray).as_type(np.uint16) / 2**16
+		im = from_adu(np.array(self.camera.ImageArray).astype(np.uint16))
 		return im.T
 
 	def stop_capture(self):
@@ -12,7 +12,7 @@ from kivy.properties import StringProperty, NumericProperty, BooleanProperty
 from kivy.clock import Clock
 
 from jocular.cameras.genericcamera import GenericCamera
-from jocular.utils import toast
+from jocular.utils import toast, from_adu
 
 
 class ASICamera(GenericCamera):
@@ -308,7 +308,7 @@ class ASICamera(GenericCamera):
 			whbi = self.asicamera.get_roi_format()
 			shape = [whbi[1], whbi[0]]
 			img = np.frombuffer(data, dtype=np.uint16)
-			return img.reshape(shape) / 2 ** 16
+			return from_adu(img.reshape(shape))
 		except Exception as e:
 			logger.warning('{:}'.format(e))
 			return None
@@ -292,15 +292,16 @@ class SXCamera(GenericCamera):
 		even = np.frombuffer(even8, dtype='uint16').reshape(self.half_height, self.width)
 
 		# generate new array (full height)
-		pix = np.zeros((self.height, self.width))
+		pix = np.empty((self.height, self.width), dtype=np.float32)
 
 		# insert odd rows
 		pix[::2, :] = odd
 
 		# insert even rows and normalise to account for slight delay in reading
-		pix[1::2, :] = even * (np.mean(odd) / np.mean(even))
+		np.multiply(even, np.float32(np.mean(odd) / np.mean(even)), out=pix[1::2, :])
 
-		return pix / 2 ** 16
+		pix *= np.float32(1 / 2 ** 16)
+		return pix
 
 
 
@@ -10,7 +10,7 @@ from loguru import logger
 from kivy.clock import Clock
 
 from jocular.cameras.genericcamera import GenericCamera
-from jocular.utils import toast
+from jocular.utils import toast, from_adu
 
 SX_CLEAR_PIXELS = 1
 SX_READ_PIXELS_DELAYED = 2
@@ -204,7 +204,7 @@ class SXUltrastarCamera(GenericCamera):
 			self.exposure_command()
 			pix = self.sxcamera.read(0x82, self.height * self.width, timeout=10000)
 			pix = np.frombuffer(pix, dtype='uint16').reshape(self.half_height, self.width)
-			self.last_capture = pix / 2 ** 16
+			self.last_capture = from_adu(pix)
 			if self.on_capture is not None:
 				self.on_capture()
 		except Exception as e:
@@ -220,7 +220,7 @@ class SXUltrastarCamera(GenericCamera):
 			logger.debug('getting odd pixels')
 			pix = self.sxcamera.read(0x82, self.height * self.width, 10000)
 			pix = np.frombuffer(pix, dtype='uint16').reshape(self.half_height, self.width)
-			return pix / 2 ** 16
+			return from_adu(pix)
 		except Exception as e:
 			self.handle_failure('sxcamera_read', e)
 
@@ -11,7 +11,7 @@ from kivy.properties import StringProperty, BooleanProperty
 from kivy.clock import Clock
 
 from jocular.component import Component
-from jocular.utils import move_to_dir, toast
+from jocular.utils import move_to_dir, toast, as_image
 from jocular.image import Image, ImageNotReadyException, is_fit
 from jocular.cameras.genericcamera import GenericCamera
 
@@ -318,8 +318,8 @@ class WatchedCamera(GenericCamera):
 			return im
 		binfac = int(b[0]) # i.e. 2 x 2 gives 2, etc
 		if self.bin_method == 'interpolation':
-			return rescale(im, 1 / binfac, anti_aliasing=True, mode='constant', 
-				preserve_range=True, multichannel=False)
-		return downscale_local_mean(im, (binfac, binfac))
+			return as_image(rescale(im, 1 / binfac, anti_aliasing=True, mode='constant',
+				preserve_range=True, multichannel=False))
+		return as_image(downscale_local_mean(im, (binfac, binfac)))
 
 
@@ -0,0 +1,105 @@
+''' Float32 conversions between sRGB and CIE LAB (D65 illuminant, 2 degree
+    observer) giving the same results as skimage's rgb2lab and lab2rgb. The
+    sRGB gamma curves are applied via lookup tables. For LAB to RGB the
+    chroma planes are first converted to offsets in f-space (see chroma)
+    so that when only the luminance changes, recombination is a handful of
+    full-frame float32 operations.
+'''
+
+import numpy as np
+
+from jocular.stretcher import apply_lut, lut_size
+
+
+# D65 reference white
+xyz_ref_white = np.array([0.95047, 1., 1.08883])
+
+xyz_from_rgb = np.array([
+    [0.412453, 0.357580, 0.180423],
+    [0.212671, 0.715160, 0.072169],
+    [0.019334, 0.119193, 0.950227]])
+
+rgb_from_xyz = np.linalg.inv(xyz_from_rgb)
+
+# fold reference white into matrices
+rgb_from_fxyz = (rgb_from_xyz * xyz_ref_white[np.newaxis, :]).astype(np.float32)
+fxyz_from_rgb = (xyz_from_rgb / xyz_ref_white[:, np.newaxis]).astype(np.float32)
+
+
+def _linear_from_srgb(c):
+    return np.where(c > 0.04045, ((c + 0.055) / 1.055) ** 2.4, c / 12.92)
+
+
+def _srgb_from_linear(c):
+    return np.where(c > 0.0031308, 1.055 * np.power(np.maximum(c, 0.0031308), 1 / 2.4) - 0.055, 12.92 * c)
+
+
+_x = np.linspace(0, 1, lut_size, dtype=np.float64)
+linear_lut = _linear_from_srgb(_x).astype(np.float32)
+srgb_lut = _srgb_from_linear(_x).astype(np.float32)
+
+
+def _f(t):
+    # forward LAB companding; computing both branches is faster than masking
+    lin = t * np.float32(7.787)
+    lin += np.float32(16 / 116)
+    return np.where(t <= 0.008856, lin, np.cbrt(t))
+
+
+def _finv(t):
+    # inverse LAB companding
+    lin = t - np.float32(16 / 116)
+    lin *= np.float32(1 / 7.787)
+    cube = t * t
+    cube *= t
+    return np.where(t <= 0.2068966, lin, cube)
+
+
+# Y as a function of luminance in range 0-1
+y_lut = _finv(((100 * _x + 16) / 116).astype(np.float32))
+
+
+def rgb_to_lab(R, G, B):
+    ''' Convert sRGB planes in the range 0-1 to LAB, returned as a float32
+        array with channels last
+    '''
+    lin = [apply_lut(c, linear_lut) for c in [R, G, B]]
+    fx, fy, fz = [_f(m[0] * lin[0] + m[1] * lin[1] + m[2] * lin[2]) for m in fxyz_from_rgb]
+    lab = np.empty(fy.shape + (3,), dtype=np.float32)
+    np.multiply(fy, 116, out=lab[..., 0])
+    lab[..., 0] -= 16
+    np.subtract(fx, fy, out=lab[..., 1])
+    lab[..., 1] *= 500
+    np.subtract(fy, fz, out=lab[..., 2])
+    lab[..., 2] *= 200
+    return lab
+
+
+def chroma(A, B):
+    ''' Offsets of f(X) and f(Z) from f(Y) corresponding to A and B planes;
+        these only change when the colour does
+    '''
+    return np.multiply(A, 1 / 500, dtype=np.float32), np.multiply(B, -1 / 200, dtype=np.float32)
+
+
+def lab_to_rgb(L, chroma_planes):
+    ''' Convert luminance L (range 0-1, rather than 0-100) and chroma planes
+        to an sRGB float32 image with channels last
+    '''
+    dx, dz = chroma_planes
+    fy = np.multiply(L, 100 / 116, dtype=np.float32)
+    fy += np.float32(16 / 116)
+    fx = _finv(fy + dx)
+    fy += dz
+    np.maximum(fy, 0, out=fy)  # as skimage, no negative z
+    fz = _finv(fy)
+    y = apply_lut(L, y_lut)
+
+    # planes are written contiguously and returned as a channels-last view
+    rgb = np.empty((3,) + y.shape, dtype=np.float32)
+    for c, m in enumerate(rgb_from_fxyz):
+        plane = np.multiply(fx, m[0])
+        plane += m[1] * y
+        plane += m[2] * fz
+        rgb[c] = apply_lut(plane, srgb_lut)
+    return np.moveaxis(rgb, 0, -1)
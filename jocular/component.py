@@ -46,6 +46,9 @@ class Component(EventDispatcher):
         if name not in cls.components:
             cls.components[name] = obj
             App.get_running_app().gui.initialise_component(name)
+            # components loaded on demand after bind_status still report status
+            if 'Status' in cls.components:
+                cls.components['Status'].bind_status(name, obj)
         else:
             logger.error(f'name clash for {name}')
 
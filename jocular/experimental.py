@@ -40,6 +40,7 @@ class Experimental(Panel, Component):
             size_hint=(None, None), width=dp(200), height=dp(30), 
             step=0.1, min=1, max=3, value=self.fracbin)
         slider.bind(value=self.fracbin_changed)
+        slider.bind(dragging=self.app.gui.control_dragged)
         gl.add_widget(slider)
         layout.add_widget(gl)
         self.app.gui.add_widget(self)
@@ -1,61 +1,312 @@
-'''  Fast gradient and background estimation
+'''  Fast gradient, background and image statistics estimation
 '''
 
 import math
+import weakref
+from threading import RLock
 import numpy as np
 from numpy.polynomial import polynomial
+from scipy.ndimage import median_filter
 from loguru import logger
 
+from jocular.utils import block_mean
 
-def estimate_background(im):
-    # requires about .7ms for Lodestar image on MacBook Pro 2020
 
-    # fit at random pixels and remove outliers
-    npts = 500
+def sample_pixels(im, npts=500, rng=None):
+    ''' Return column and row coordinates and values of npts random pixels
+    '''
+    rng = np.random.default_rng() if rng is None else rng
     r, c = im.shape
+    x = rng.integers(0, c, size=npts)
+    y = rng.integers(0, r, size=npts)
+    return x, y, im[y, x]
+
+
+def estimate_background(im):
+    # requires about .7ms for Lodestar image on MacBook Pro 2020
 
-    x = np.random.random_integers(0, high=c-1, size=(npts))
-    y = np.random.random_integers(0, high=r-1, size=(npts))
-    z = np.array([im[j, i] for i, j in zip(x, y)])
+    # fit at random pixels and remove outliers
+    _, _, z = sample_pixels(im)
 
-    # remove outliers e.g. stars
-    zlo, zhi = np.percentile(z, 20), np.percentile(z, 80)
-    inds = [i for i, j in enumerate(z) if (j >= zlo) and (j <= zhi)]
-    zinds = z[inds]
+    # remove outliers e.g. stars
+    zlo, zhi = np.percentile(z, [20, 80])
+    zinds = z[(z >= zlo) & (z <= zhi)]
 
     return np.mean(zinds), np.std(zinds)
-   
 
-def estimate_gradient(im):
-    # simple estimation of 2d linear gradient surface ~12ms
 
-    def _polyfit2d(x, y, f, deg):
-        deg = np.asarray(deg)
-        vander = polynomial.polyvander2d(x, y, deg)
-        vander = vander.reshape((-1, vander.shape[-1]))
-        f = f.reshape((vander.shape[0],))
-        c = np.linalg.lstsq(vander, f, rcond=None)[0]
-        return c.reshape(deg+1)
+class ImageCache:
+    ''' Cache of results computed from images, valid for as long as the image
+        they were computed from exists; stacks are replaced rather than modified
+        when subs are added, so the cache is effectively per stack version
+    '''
 
-    try:
-        # fit at random pixels
-        npts = 500
+    def __init__(self, max_cached=8):
+        self.max_cached = max_cached
+        self.results = {}  # map from (id of image, params) to (weakref to image, result)
+        self.lock = RLock()  # cache is used by colour worker as well as main thread
+
+
+    def get(self, im, params=None):
+        with self.lock:
+            cached = self.results.get((id(im), params))
+        if cached is not None and cached[0]() is im:
+            return cached[1]
+
+
+    def put(self, im, result, params=None):
+        key = (id(im), params)
+        try:
+            ref = weakref.ref(im, lambda r, key=key: self.drop(key, r))
+        except TypeError:
+            # not an object we can reference so don't cache
+            return result
+        with self.lock:
+            if len(self.results) >= self.max_cached:
+                del self.results[next(iter(self.results))]
+            self.results[key] = (ref, result)
+        return result
+
+
+    def drop(self, key, ref):
+        with self.lock:
+            cached = self.results.get(key)
+            if cached is not None and cached[0] is ref:
+                del self.results[key]
+
+
+    def clear(self):
+        self.results = {}
+
+
+class GradientEngine:
+    ''' Fits a low-order 2d polynomial gradient surface to an image.
+        Evaluation uses the fact that the polynomial is separable: with
+        per-shape float32 bases Vx (columns) and Vy (rows), the surface is
+        Vy @ (Vx @ C).T for coefficient matrix C, so no full-frame meshgrids
+        are needed. Fitted surfaces are cached per image.
+    '''
+
+    def __init__(self, deg=(2, 1), npts=500, max_cached=8):
+        self.deg = deg
+        self.npts = npts
+        self.bases = {}  # map from shape to (Vx, Vy)
+        self.surfaces = ImageCache(max_cached=max_cached)
+
+
+    def basis(self, shape):
+        ''' Powers of normalised column and row coordinates for this shape
+        '''
+        if shape not in self.bases:
+            r, c = shape
+            x = np.linspace(0, 1, c, dtype=np.float32)
+            y = np.linspace(0, 1, r, dtype=np.float32)
+            self.bases[shape] = (
+                x[:, np.newaxis] ** np.arange(self.deg[0] + 1, dtype=np.float32),
+                y[:, np.newaxis] ** np.arange(self.deg[1] + 1, dtype=np.float32))
+        return self.bases[shape]
+
+
+    def fit(self, im):
+        ''' Least squares fit to background pixels sampled at random,
+            returning coefficient matrix in normalised coordinates
+        '''
         r, c = im.shape
+        # seeded by shape so that repeated fits to the same image agree
+        x, y, z = sample_pixels(im, npts=self.npts, rng=np.random.default_rng(r * c))
+        zlo, zhi = np.percentile(z, [20, 80])
+        keep = (z >= zlo) & (z <= zhi)
+        vander = polynomial.polyvander2d(
+            x[keep] / max(1, c - 1), y[keep] / max(1, r - 1), self.deg)
+        coefs = np.linalg.lstsq(vander, z[keep].astype(np.float64), rcond=None)[0]
+        return coefs.reshape(np.asarray(self.deg) + 1)
+
 
-        x = np.random.random_integers(0, high=c-1, size=(npts))
-        y = np.random.random_integers(0, high=r-1, size=(npts))
-        z = np.array([im[j, i] for i, j in zip(x, y)])
+    def evaluate(self, coefs, shape):
+        Vx, Vy = self.basis(shape)
+        return Vy @ (Vx @ coefs.astype(np.float32)).T
 
-        zlo, zhi = np.percentile(z, 20), np.percentile(z, 80)
-        inds = [i for i, j in enumerate(z) if (j >= zlo) and (j <= zhi)]
 
-        # perform fit
-        return polynomial.polyval2d(*np.meshgrid(np.arange(c), np.arange(r)), 
-            _polyfit2d(x[inds], y[inds], z[inds], deg=[2, 1]))
+    def surface(self, im):
+        ''' Return (read-only) fitted gradient surface for im, using cache
+        '''
+        g = self.surfaces.get(im)
+        if g is None:
+            g = self.evaluate(self.fit(im), im.shape)
+            g.flags.writeable = False
+            self.surfaces.put(im, g)
+        return g
 
+
+gradient_engine = GradientEngine()
+
+
+def estimate_gradient(im):
+    # estimation of 2d polynomial gradient surface (float32, cached per image)
+
+    try:
+        return gradient_engine.surface(im)
     except Exception as e:
         logger.warning(f'gradient estimation failed; returning zeros ({e})')
-        return np.zeros(im.shape)
+        return np.zeros(im.shape, dtype=np.float32)
+
+
+def sigma_clipped_median(boxes, sigma=3, iters=5):
+    ''' Median along last axis of boxes after iterative sigma clipping; uses
+        the fact that sorting places nans (clipped or padding values) last,
+        which is much faster than nanmedian
+    '''
+
+    def _median(srt, n):
+        lo = np.take_along_axis(srt, np.maximum(0, (n - 1) // 2)[..., np.newaxis], axis=-1)
+        hi = np.take_along_axis(srt, (n // 2)[..., np.newaxis], axis=-1)
+        return (lo + hi) / 2
+
+    srt = np.sort(boxes, axis=-1)
+    n = np.sum(~np.isnan(srt), axis=-1)
+    for _ in range(iters):
+        med = _median(srt, n)
+        std = np.nanstd(srt, axis=-1, keepdims=True)
+        clip = np.abs(srt - med) > sigma * std
+        if not clip.any():
+            break
+        srt[clip] = np.nan
+        srt.sort(axis=-1)
+        n = np.sum(~np.isnan(srt), axis=-1)
+    return _median(srt, n)[..., 0]
+
+
+def bilinear_upsample(mesh, shape, box):
+    ''' Interpolate mesh of values at centres of box x box regions to shape,
+        one axis at a time; box may be a (rows, columns) pair
+    '''
+
+    box_y, box_x = box if isinstance(box, tuple) else (box, box)
+
+    def _weights(n, nmesh, box):
+        # mesh index and weight of right-hand neighbour for each coordinate
+        pos = np.clip((np.arange(n, dtype=np.float32) + .5) / box - .5, 0, nmesh - 1)
+        i0 = np.minimum(pos.astype(int), max(0, nmesh - 2))
+        return i0, np.minimum(i0 + 1, nmesh - 1), (pos - i0).astype(np.float32)
+
+    # interpolate along columns of the (small) mesh first, then fill the
+    # full-size result one band of rows (sharing mesh rows) at a time
+    x0, x1, wx = _weights(shape[1], mesh.shape[1], box_x)
+    cols = mesh[:, x0] + wx * (mesh[:, x1] - mesh[:, x0])
+    y0, y1, wy = _weights(shape[0], mesh.shape[0], box_y)
+    out = np.empty(shape, dtype=np.float32)
+    starts = np.flatnonzero(np.diff(y0, prepend=-1))
+    for ya, yb in zip(starts, list(starts[1:]) + [shape[0]]):
+        i, j = y0[ya], y1[ya]
+        np.multiply(wy[ya:yb, np.newaxis], cols[j] - cols[i], out=out[ya:yb])
+        out[ya:yb] += cols[i]
+    return out
+
+
+regional_cache = ImageCache(max_cached=4)
+
+
+def estimate_regional_gradient(im, box=50, filter_size=4, binfac=None):
+    ''' Zero-median background surface from sigma-clipped medians of box x box
+        regions, computed on a binned copy of im, median-filtered over
+        filter_size regions and upsampled bilinearly; cached per image
+    '''
+
+    params = (box, filter_size, binfac)
+    g = regional_cache.get(im, params)
+    if g is not None:
+        return g
+
+    try:
+        # bin so that each region contains 10 x 10 binned pixels
+        binfac = max(1, box // 10) if binfac is None else binfac
+        binned = block_mean(im, binfac=binfac)
+        bbox = max(1, box // binfac)
+
+        # pad with nans so regions tile the binned image
+        h, w = binned.shape
+        ny, nx = math.ceil(h / bbox), math.ceil(w / bbox)
+        padded = np.full((ny * bbox, nx * bbox), np.nan, dtype=np.float32)
+        padded[:h, :w] = binned
+        boxes = padded.reshape(ny, bbox, nx, bbox).transpose(0, 2, 1, 3).reshape(ny, nx, -1)
+
+        mesh = sigma_clipped_median(boxes)
+        mesh[np.isnan(mesh)] = np.nanmedian(mesh)
+        if filter_size > 1:
+            mesh = median_filter(mesh, size=filter_size, mode='nearest')
+
+        g = bilinear_upsample(mesh - np.median(mesh), im.shape, box=bbox * binfac)
+
+    except Exception as e:
+        logger.warning(f'regional gradient estimation failed; returning zeros ({e})')
+        g = np.zeros(im.shape, dtype=np.float32)
+
+    g.flags.writeable = False
+    return regional_cache.put(im, g, params)
+
+
+class ImageStats:
+    ''' Statistics of an image derived from a 16-bit histogram spanning the
+        image's own min to max (so values above 1, e.g. unnormalised data,
+        are resolved). After finding the exact min and max, the histogram
+        and exact mean are built in a single pass over chunks of the image
+        so that temporaries stay in cache.
+    '''
+
+    nbins = 2 ** 16
+
+    def __init__(self, im, chunk=2 ** 20):
+        top = self.nbins - 1
+        flat = im.ravel()
+        self.n = flat.size
+        self.min = float(np.min(flat)) if self.n else 0.
+        self.max = float(np.max(flat)) if self.n else 0.
+        self.scale = top / max(self.max - self.min, 1e-12)  # bins per unit value
+        n = min(chunk, self.n)
+        buf = np.empty(n, dtype=np.float32)
+        inds = np.empty(n, dtype=np.intp)
+        self.counts = np.zeros(self.nbins, dtype=np.int64)
+        total = 0.
+        for i in range(0, self.n, chunk):
+            x = flat[i: i + chunk]
+            b, q = buf[:x.size], inds[:x.size]
+            total += float(np.sum(x, dtype=np.float64))
+            np.subtract(x, self.min, out=b)
+            b *= self.scale
+            b += .5
+            np.clip(b, 0, top, out=b)
+            q[...] = b
+            self.counts += np.bincount(q, minlength=self.nbins)
+        self.mean = total / max(1, self.n)
+        self.cumulative = np.cumsum(self.counts)
+
+
+    def percentile(self, p):
+        ''' Value below which p percent of pixels lie (to within 1/65535
+            of the image's range)
+        '''
+        rank = p / 100 * (self.n - 1)
+        b = np.searchsorted(self.cumulative, rank, side='right')
+        return min(self.max, max(self.min, self.min + b / self.scale))
+
+
+    def fraction_above(self, v):
+        if v < self.min:
+            return 1.
+        b = int((v - self.min) * self.scale + .5)
+        return (self.n - self.cumulative[min(b, self.nbins - 1)]) / max(1, self.n)
+
+
+stats_cache = ImageCache(max_cached=8)
+
+
+def histogram_stats(im):
+    ''' ImageStats for im, cached per image (so per stack version)
+    '''
+    stats = stats_cache.get(im)
+    if stats is None:
+        stats = stats_cache.put(im, ImageStats(im))
+    return stats
 
 
 def image_stats(im):
@@ -66,16 +317,16 @@ def image_stats(im):
     if math.isnan(std_back):
         std_back = 0
 
-    imr = im.ravel()
+    stats = histogram_stats(im)
 
     return {
         'background': mean_back,
         'std. dev.': std_back,
         #'central 75%': percentile_clip(imr, perc=75),
-        '99.99': np.percentile(imr, 99.99),
+        '99.99': stats.percentile(99.99),
         #'99.9 percentile': np.percentile(imr, 99.9),
-        'min': np.min(imr),
-        'max': np.max(imr),
-        'mean': np.mean(imr),
-        'over': np.mean(imr > .99) * 100
+        'min': stats.min,
+        'max': stats.max,
+        'mean': stats.mean,
+        'over': stats.fraction_above(.99) * 100
         }
@@ -409,6 +409,7 @@ class GUI(FloatLayout):
   
         if control_type == 'JLever':
             w.bind(value=partial(self.on_action, wname))
+            w.bind(selected=self.control_dragged)
         else:
             self.add_widget(w)
             w.bind(on_press=partial(self.on_action, wname))
@@ -418,6 +419,13 @@ class GUI(FloatLayout):
         self.gui[wname] = spec
 
 
+    def control_dragged(self, widget, dragging):
+        ''' Let View know when a lever or slider is being dragged so that
+            images can be rendered at screen resolution in the meantime
+        '''
+        Component.get('View').dragging = dragging
+
+
     def initialise_component(self, component):
         ''' Push initial settings into the component when it is loaded
         '''
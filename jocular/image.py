@@ -12,6 +12,8 @@ from loguru import logger
 
 from jocular import __version__
 from jocular.exposurechooser import str_to_exp
+from jocular.gradient import ImageStats
+from jocular.utils import from_adu, as_image
 
 ''' map from FITs names (converted to lower case) to Image attributes; 
     (1) can have multiple names mapping to same attribute
@@ -258,14 +260,11 @@ class Image:
                 if check_image_data:
                     bp = hdr['BITPIX']
                     if bp < 0:
-                        self.image = hdu1[0].data
+                        self.image = as_image(hdu1[0].data)
                     else:
-                        self.image = hdu1[0].data / 2 ** bp
+                        self.image = from_adu(hdu1[0].data, bits=bp)
 
-                    self.minval = np.min(self.image) * 100
-                    self.maxval = np.percentile(self.image, 99.99) * 100
-                    self.meanval = np.mean(self.image) * 100
-                    self.overexp = np.mean(self.image > .99) * 100
+                    self.update_stats()
                 else:
                     self.image = None
                     self.minval, self.maxval, self.meanval, self.overexp = .0, .0, .0, .0
@@ -480,18 +479,27 @@ class Image:
             try:
                 with fits.open(self.path) as hdu:
                     bp = hdu[0].header['BITPIX']
-                    self.image = np.array(hdu[0].data, dtype=np.float32)
                     if bp > 0:
-                        self.image /= (2 ** bp)
-                    self.minval = np.min(self.image) * 100
-                    self.maxval = np.percentile(self.image, 99.99) * 100
-                    self.meanval = np.mean(self.image) * 100
-                    self.overexp = np.mean(self.image > .99) * 100   
+                        self.image = from_adu(hdu[0].data, bits=bp)
+                    else:
+                        self.image = np.array(hdu[0].data, dtype=np.float32)
+                    self.update_stats()
             except Exception as e:
                 logger.warning(f'cannot read image data from {self.path} ({e})')
         return self.image
 
 
+    def update_stats(self):
+        ''' Percentage min, 99.99 percentile, mean and overexposure from a
+            single histogram pass
+        '''
+        stats = ImageStats(self.image)
+        self.minval = stats.min * 100
+        self.maxval = stats.percentile(99.99) * 100
+        self.meanval = stats.mean * 100
+        self.overexp = stats.fraction_above(.99) * 100
+
+
     # def get_cached_image(self):
     #     ''' Images are stored in a temp folder
     #     '''
@@ -2,51 +2,76 @@
 '''
 
 import math
+import itertools
+from types import SimpleNamespace
+from collections import OrderedDict
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import numpy as np
+from loguru import logger
 
-from skimage.transform import resize, rescale, downscale_local_mean
+from scipy.ndimage import gaussian_filter
+from skimage.transform import resize, rescale
 from skimage import filters
 from skimage.morphology import disk
 
-from astropy.stats import SigmaClip
-from photutils.background import Background2D, MedianBackground
-
 from kivy.app import App
 from kivy.properties import BooleanProperty, NumericProperty, StringProperty
 
 from jocular.settingsmanager import JSettings
-from jocular.gradient import estimate_gradient, estimate_background, image_stats
+from jocular.gradient import (
+    estimate_gradient, estimate_regional_gradient, estimate_background,
+    image_stats, histogram_stats, bilinear_upsample
+    )
 from jocular.component import Component
+from jocular.utils import block_mean, check_dtype
 
 
-def TNR(im, ksize=20, method='gaussian', param=1, binfac=1):
-    ''' Tony's Noise Reduction
+def blur(im, sigma, method='gaussian', binfac=1, mode='nearest'):
+    ''' Float32 blurred version of im, computed on a copy binned by binfac
+        and upsampled bilinearly; gaussian blur is separable. As with the
+        original downscale_local_mean version, im is zero-padded to a
+        multiple of binfac and the binned result stretched back over im
     '''
- 
-    ksize = int(ksize)
+    binfac = int(binfac)
     if binfac > 1:
-        im2 = downscale_local_mean(im, (binfac, binfac))
+        h, w = im.shape[:2]
+        ph, pw = -h % binfac, -w % binfac
+        im2 = block_mean(np.pad(im, ((0, ph), (0, pw))) if ph or pw else im, binfac=binfac)
+    else:
+        im2 = im
+    if method == 'median':
+        neighbourhood = disk(radius=sigma / binfac)
+        bkg = (filters.rank.median(im2, neighbourhood) / 255.).astype(np.float32)
     else:
-        im2 = im.copy()
-    if method == 'gaussian':
-        bkg = filters.gaussian(im2, ksize / binfac)
-    elif method == 'median':
-        neighbourhood = disk(radius=ksize / binfac)
-        bkg = filters.rank.median(im2, neighbourhood) / 255.
+        bkg = gaussian_filter(im2.astype(np.float32, copy=False), sigma / binfac,
+            mode=mode)
     if binfac > 1:
-        h, w = im.shape
-        bh, bw = bkg.shape
-        # use fast upsizing if result is a multiple
-        if bh * binfac == h and bw * binfac == w:
-            bkg = rescale(bkg, (binfac, binfac))
-        else:
-            bkg = resize(bkg, im.shape)
+        bkg = bilinear_upsample(bkg, im.shape,
+            box=(h / bkg.shape[0], w / bkg.shape[1]))
+    return bkg
 
-    return ((im - bkg) / (1 + np.exp(param) * np.exp(-27 * im))) + bkg
 
+def TNR_blend(im, bkg, param=1):
+    ''' Tony's Noise Reduction: attenuate departures from background bkg, more so in darker areas
+    '''
+    out = np.multiply(im, -27, dtype=np.float32)
+    np.exp(out, out=out)
+    out *= np.exp(param)
+    out += 1
+    np.divide(im - bkg, out, out=out)
+    out += bkg
+    return out
 
-def unsharp_masking(im, radius=5, amount=1):
-    return filters.unsharp_mask(im, radius=radius, amount=amount)
+
+def unsharp_blend(im, blurred, amount=1):
+    ''' Add amount of high-pass detail (im - blurred) back to im
+    '''
+    out = np.subtract(im, blurred, dtype=np.float32)
+    out *= amount
+    out += im
+    return np.clip(out, 0, 1, out=out)
 
 
 def fractional_bin(im, binfac=1, original_size=True):
@@ -68,11 +93,23 @@ def fractional_bin(im, binfac=1, original_size=True):
         return binned
 
 
-def estimate_gradient_local(im):
-    bkg_estimator = MedianBackground()
-    sigma_clip = SigmaClip(sigma=3.)
-    bkg = Background2D(im, (50, 50), filter_size=(4, 4), sigma_clip=sigma_clip, bkg_estimator=bkg_estimator)
-    return bkg.background - bkg.background_median
+def whitepoint(im):
+    return histogram_stats(im).percentile(99.99)
+
+
+def subtract_gradient(im, gradient, amount=100):
+    ''' Subtract amount % of (zero-mean) gradient from im
+    '''
+    return im - (amount / 100) * gradient
+
+
+def normalise(im, black=0, white=1):
+    ''' Map black-white range to 0-1, clipping values outside
+    '''
+    im = (im - black) / (white - black)
+    im[im > 1] = 1
+    im[im < 0] = 0
+    return im
 
 
 
@@ -99,6 +136,7 @@ class Monochrome(Component, JSettings):
     TNR_binning = StringProperty('1')
     RL_width = NumericProperty(0)
     background_method = StringProperty('2D planar')
+    max_prefetched = 3  # subs whose final luminance and gradient are kept (~3 frames each)
     imstats_units = StringProperty('percentage')
 
     configurables = [
@@ -134,15 +172,33 @@ class Monochrome(Component, JSettings):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.mono = None  # not 100% sure why this is needed on init
+        self._versions = itertools.count()  # shared by mono and gradient (incl. prefetched)
+        self._mono_version = next(self._versions)  # changes whenever mono changes
+        self._gradient_version = next(self._versions)  # changes whenever gradient is re-estimated
+        self._stages = {}  # map from stage name to (key, output) of luminance pipeline
+        self._final = None  # (render key, output) of most recent full frame luminance
+        self._mono_is_sub = False  # whether mono is a light sub whose state can be kept
+        self.prefetched = OrderedDict()  # LRU map from id of sub image to its state
+        self.prefetching = {}  # map from sub name to future
+        self.prefetch_lock = Lock()
+        self.prefetch_worker = ThreadPoolExecutor(max_workers=1)
+        self._info_key = None
+        self.lum_factor = 1  # downsampling factor of most recent luminance
+        self.lum_region = None  # region of frame covered by most recent luminance, if not all
         self.view = Component.get("View")
         self.stacker = Component.get("Stacker")
         self.gui = App.get_running_app().gui
 
 
     def on_new_object(self):
-        self.mono = None
+        self.cancel_prefetch()
+        self.set_mono(None)
+        self._stages = {}
+        self._info_key = None
+        self._gradient_version = next(self._versions)
         self.lum = None  # luminosity (after applying stretch, B/W etc to mono)
         self._gradient = None  # pixel-by-pixel zero-mean gradient estimate to subtract
+        self._gradient_surface = None  # fitted gradient surface from which _gradient derives
         self._std_background = None  # std dev of background estimated from gradient
         self._blackpoint = None  # automatic estimate of blackpoint
         self._whitepoint = None  # automatic estimate of whitepoint
@@ -220,11 +276,15 @@ class Monochrome(Component, JSettings):
     def on_autowhite(self, *args):
         if self.autowhite:
             if hasattr(self, "mono") and self.mono is not None:
+                self._stages.pop('whitepoint', None)
                 self.update_whitepoint(self.mono)
                 self.adjust_lum()
 
-    # def on_background_method(self, *args):
-    #     self.update_gradient()
+    def on_background_method(self, *args):
+        if hasattr(self, "mono") and self.mono is not None and self._gradient is not None:
+            self.update_gradient(self.mono)
+            self.adjust_lum()
+
 
     def update_blackpoint(self, im):
         self._blackpoint, self._std_background = estimate_background(im)
@@ -232,25 +292,180 @@ class Monochrome(Component, JSettings):
 
 
     def update_whitepoint(self, im):
-        self._whitepoint = np.percentile(im.ravel(), 99.99)
+        self._whitepoint = whitepoint(im)
         self.gui.set("white", float(self._whitepoint))
+        return self._whitepoint
+
+
+    def gradient_surface(self, im):
+        if self.background_method == '2D planar':
+            return estimate_gradient(im)
+        return estimate_regional_gradient(im)
 
 
     def update_gradient(self, im):
         # Estimate gradient and normalise to zero mean
-        if self.background_method == '2D planar':
-            g = estimate_gradient(im)
-            self._gradient = g - np.mean(g)
+        g = self.gradient_surface(im)
+        # surfaces are cached per image so no change if image is unchanged
+        if g is self._gradient_surface:
+            return
+        self._gradient_surface = g
+        self._gradient = g - np.mean(g)
+        self._gradient_version = next(self._versions)
+
+
+    def set_mono(self, im, is_sub=False):
+        ''' Change the image at the head of the luminance pipeline, keeping
+            the state of the outgoing image if it is a light sub
+        '''
+        self.keep_state()
+        self.mono = im
+        self._mono_version = next(self._versions)
+        self._mono_is_sub = is_sub
+        self._stages = {}
+        self._final = None
+
+
+    def state(self):
+        ''' Per-image quantities and stage outputs of the luminance pipeline
+        '''
+        return SimpleNamespace(
+            mono=self.mono,
+            version=self._mono_version,
+            gradient_surface=self._gradient_surface,
+            gradient=self._gradient,
+            gradient_version=self._gradient_version,
+            blackpoint=self._blackpoint,
+            std_background=self._std_background,
+            whitepoint=self._whitepoint,
+            background_method=self.background_method,
+            stages=self._stages,
+            final=self._final)
+
+
+    def keep_state(self):
+        # retain final luminance of outgoing light sub (but not its intermediate
+        # stages) so that stepping back to it is instant
+        if self.mono is not None and self._mono_is_sub:
+            st = self.state()
+            st.stages = {}
+            self.store_prefetched(st)
+
+
+    def restore_state(self, st):
+        ''' Make a prefetched sub the head of the luminance pipeline
+        '''
+        self.keep_state()
+        self.mono, self._mono_version, self._stages = st.mono, st.version, st.stages
+        self._final = st.final
+        self._mono_is_sub = True
+        self._gradient_surface, self._gradient = st.gradient_surface, st.gradient
+        self._gradient_version = st.gradient_version
+        if self.autoblack:
+            if st.blackpoint is None:
+                st.blackpoint, st.std_background = estimate_background(st.mono)
+            self._blackpoint, self._std_background = st.blackpoint, st.std_background
+            self.gui.set("black", float(self._blackpoint))
+        # if whitepoint is unknown it is estimated when rendering
+        if self.autowhite and st.whitepoint is not None:
+            self._whitepoint = st.whitepoint
+            self.gui.set("white", float(self._whitepoint))
+
+
+    def prefetch(self, subs):
+        ''' In the background, load light subs (typically those either side of
+            the selected sub) and pre-render their luminance with the current
+            settings so that stepping or animating to them is instant
+        '''
+        names = {s.name for s in subs}
+        for name, future in list(self.prefetching.items()):
+            if name not in names or future.done():
+                future.cancel()
+                del self.prefetching[name]
+        for sub in subs:
+            if sub.name not in self.prefetching:
+                self.prefetching[sub.name] = self.prefetch_worker.submit(self.prefetch_sub, sub)
+
+
+    def prefetch_sub(self, sub):
+        try:
+            self._prefetch_sub(sub)
+        except Exception as e:
+            logger.warning(f'problem prefetching {sub.name} ({e})')
+
+
+    def _prefetch_sub(self, sub):
+        im = sub.get_image()
+        if im is None or im is self.mono or self.prefetched_state(im, remove=False) is not None:
+            return
+        st = self.image_state(im)
+        self.luminance(state=st)
+        st.stages = {}  # keep only the final luminance
+        self.store_prefetched(st)
+
+
+    def image_state(self, im, do_gradient=True):
+        ''' Estimate the per-image quantities that render_sub would for im,
+            returning a new state with empty stages
+        '''
+        g = self.gradient_surface(im) if do_gradient else None
+        if self.autoblack:
+            blackpoint, std_background = estimate_background(im)
         else:
-            self._gradient = estimate_gradient_local(im)
+            blackpoint, std_background = self._blackpoint, self._std_background
+        return SimpleNamespace(
+            mono=im,
+            version=next(self._versions),
+            gradient_surface=g,
+            gradient=None if g is None else g - np.mean(g),
+            gradient_version=next(self._versions),
+            blackpoint=blackpoint,
+            std_background=std_background,
+            whitepoint=self._whitepoint,  # estimated by luminance if autowhite
+            background_method=self.background_method,
+            stages={},
+            final=None)
+
+
+    def offscreen_luminance(self, im, do_gradient=True):
+        ''' Full frame luminance of im with the current settings, computed
+            without affecting the display, controls or pipeline (can be called
+            from any thread, e.g. to render animations)
+        '''
+        return self.luminance(state=self.image_state(im, do_gradient=do_gradient))
+
+
+    def store_prefetched(self, st):
+        with self.prefetch_lock:
+            self.prefetched[id(st.mono)] = st
+            self.prefetched.move_to_end(id(st.mono))
+            while len(self.prefetched) > self.max_prefetched:
+                self.prefetched.popitem(last=False)
+
+
+    def prefetched_state(self, im, remove=True):
+        ''' Prefetched state for im if any and if its gradient method is current
+        '''
+        with self.prefetch_lock:
+            st = self.prefetched.get(id(im))
+            if st is None or st.mono is not im or st.background_method != self.background_method:
+                return None
+            if remove:
+                del self.prefetched[id(im)]
+            return st
+
+
+    def cancel_prefetch(self):
+        for future in self.prefetching.values():
+            future.cancel()
+        self.prefetching = {}
+        with self.prefetch_lock:
+            self.prefetched.clear()
+        self._mono_is_sub = False
 
 
     def update_background(self, im):
-        if self.TNR_method == 'gaussian':
-            self._background = filters.gaussian(im, self.TNR_kernel_size)
-        elif self.TNR_method == 'median':
-            neighbourhood = disk(radius=self.TNR_kernel_size)
-            self._background = filters.rank.median(im, neighbourhood) / 255.
+        self._background = blur(im, self.TNR_kernel_size, method=self.TNR_method)
 
 
     def display_sub(self, im, do_gradient=False, fwhm=None):
@@ -258,57 +473,74 @@ class Monochrome(Component, JSettings):
             displaying short subs. Only compute gradient if light sub from 
             stacker, not when calibration, nor when short
             v0.5 added: also compute grad if dims changed
+            Rendering is scheduled so only the latest sub is displayed per frame
         '''
+        Component.get('RenderScheduler').request('sub', self.render_sub, im,
+            do_gradient, fwhm, subsumes={'lum'})
+
+
+    def render_sub(self, im, do_gradient=False, fwhm=None):
 
         # ensure we are displaying subs
         if self.stacker.viewing_stack:
             self.stacker.set_to_subs()
 
-        # cache new image to allow user updates of B/W etc
-        self.mono = im
-        if do_gradient:
-            self.update_gradient(im)
-        # new in v0.5: if shape changes, update gradient
-        elif self._gradient is not None and self._gradient.shape != im.shape:
-            self.update_gradient(im) 
-        if self.autoblack:
-            self.update_blackpoint(im)
-        if self.autowhite:
-            self.update_whitepoint(im)
-        self.view.display_image(self.luminance())
+        # use prefetched state for light subs if available
+        st = self.prefetched_state(im) if do_gradient else None
+        if st is not None:
+            self.restore_state(st)
+        else:
+            # cache new image to allow user updates of B/W etc
+            self.set_mono(im, is_sub=do_gradient)
+            if do_gradient:
+                self.update_gradient(im)
+            # new in v0.5: if shape changes, update gradient
+            elif self._gradient is not None and self._gradient.shape != im.shape:
+                self.update_gradient(im)
+            if self.autoblack:
+                self.update_blackpoint(im)
+            if self.autowhite:
+                self.update_whitepoint(im)
+        self.view.display_image(self.luminance(), proxy_factor=self.lum_factor,
+            region=self.lum_region)
         self.update_info(im, fwhm=fwhm)
 
 
     def adjust_lum(self, *args):
-        ''' User has changed control position so generate luminance and either
-            display it (if sub or in mono mode) or advise multispectral of the update
+        ''' User has changed control position so schedule a render using the
+            latest control values
+        '''
+        Component.get('RenderScheduler').request('lum', self.render_lum)
+
+
+    def render_lum(self, *args):
+        ''' Generate luminance and either display it (if sub or in mono mode)
+            or advise multispectral of the update
         '''
 
         multispectral = Component.get("MultiSpectral")
-        lum = self.luminance()
-        if not self.stacker.viewing_stack:
-            self.view.display_image(lum)
+        in_colour = self.stacker.viewing_stack and multispectral.spectral_mode != "mono"
+        lum = self.luminance(full_frame=in_colour)
+        if in_colour:
+            multispectral.luminance_updated(lum)
         else:
-            if multispectral.spectral_mode == "mono":
-                self.view.display_image(lum)
-            else:
-                multispectral.luminance_updated(lum)
+            self.view.display_image(lum, proxy_factor=self.lum_factor, region=self.lum_region)
 
 
     def L_changed(self, L):
         if L is not None:
             lum = self.update_lum(L)
-            self.view.display_image(lum)
+            self.view.display_image(lum, proxy_factor=self.lum_factor)
 
 
     def update_lum(self, im):
         ''' Create gradient-adjusted luminance image; called here by L_changed and by
             MultiSpectral. Does not directly update display.
         '''
-        self.mono = im
+        self.set_mono(im)
         self.update_gradient(im)
         self.update_blackpoint(im)
-        return self.luminance()
+        return self.luminance(full_frame=True)
 
 
     def update_info(self, im, fwhm=None):
@@ -331,55 +563,138 @@ class Monochrome(Component, JSettings):
         self.info(f"{fwhmstr}{rangestr}{stats['background']:.0f} - {stats['99.99']:.0f} {unitstr}{satstr}")
 
 
-    def luminance(self, *args):
-        # Applies black, white etc to current monochrome image, updating luminosity, returning the image.
+    def _stage(self, stages, name, key, fn, *args, **kwargs):
+        ''' Return output of pipeline stage name, only recomputing it via fn
+            if key (its parameters and those of upstream stages) has changed
+        '''
+        cached = stages.get(name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        out = check_dtype(fn(*args, **kwargs), name)
+        stages[name] = (key, out)
+        return out
+
 
-        if self.mono is None:
+    def render_key(self, st, f=1, region=None):
+        ''' All inputs to the luminance pipeline for state st, so that a
+            complete render can be reused
+        '''
+        stretcher = Component.get('Stretcher')
+        return (st.version, f, region, self.fracbin,
+            st.gradient_version, self.gradient,
+            self.autoblack, st.blackpoint, st.std_background, self.black, self.lift,
+            self.autowhite, None if self.autowhite else self.white,
+            stretcher.stretch, stretcher.use_LUT, self.p1, self.noise_reduction,
+            self.unsharp_amount, self.unsharp_radius,
+            self.TNR_amount, self.TNR_kernel_size, self.TNR_method, self.TNR_binning,
+            self.imstats_units)
+
+
+    def luminance(self, *args, full_frame=False, state=None):
+        # Applies black, white etc to current monochrome image, updating luminosity, returning the image.
+        # Each stage is cached and keyed by its parameters together with the key of
+        # the previous stage, so only stages downstream of a change are recomputed.
+        # While a control is being dragged we work on a proxy downsampled to screen
+        # resolution, with its own stages so the full resolution ones are retained.
+        # Unless full_frame is requested, only the region visible in the eyepiece
+        # may be processed (see View.eyepiece_region), recorded in lum_region.
+        # If a state is supplied (see prefetch_sub) its full frame luminance is
+        # computed into its own stages without touching the display or controls.
+        # A state's final output is reused if none of the inputs have changed
+
+        st = self.state() if state is None else state
+        if st.mono is None:
             return None
+        stage = partial(self._stage, st.stages)
+
+        f = 1 if state is not None else self.view.proxy_factor()
+        sfx = '' if f == 1 else f'@{f}'
+
+        im = st.mono
+        key = st.version
 
-        im = self.mono
+        region = None
+        if not full_frame and state is None and self.fracbin <= 1:
+            region = self.view.eyepiece_region(im.shape)
+        if state is None:
+            self.lum_factor = f
+            self.lum_region = region
 
-        if self.fracbin > 1:
-            im = fractional_bin(im, binfac=self.fracbin)
+        render_key = self.render_key(st, f, region)
+        if st.final is not None and st.final[0] == render_key:
+            return st.final[1]
 
-        # compute and display image stats
-        self.update_info(im)
+        if region is not None:
+            y0, y1, x0, x1 = region
+            key = (key, 'region', region)
+            im = im[y0: y1, x0: x1]
+
+        if f > 1:
+            key = (key, 'proxy', f)
+            im = stage('proxy' + sfx, key, block_mean, im, binfac=f)
+
+        if self.fracbin / f > 1:
+            key = (key, 'fracbin', self.fracbin)
+            im = stage('fracbin' + sfx, key, fractional_bin, im, binfac=self.fracbin / f)
+
+        # compute and display image stats (prefetching only warms the stats cache)
+        if state is not None:
+            histogram_stats(im)
+        elif f == 1 and region is None and self._info_key != (key, self.imstats_units):
+            self.update_info(im)
+            self._info_key = (key, self.imstats_units)
 
         # subtract some % of gradient if we have it computed (not the case for short subs)
-        if (self._gradient is not None) and (self.gradient > 0.1):
-            im = im - (self.gradient / 100) * self._gradient
+        if (st.gradient is not None) and (self.gradient > 0.1):
+            gradient = st.gradient
+            if region is not None:
+                gradient = gradient[y0: y1, x0: x1]
+            if f > 1:
+                gradient = stage('gradient_proxy' + sfx, (st.gradient_version, f, region),
+                    block_mean, gradient, binfac=f)
+            key = (key, 'gradient', st.gradient_version, self.gradient)
+            im = stage('gradient' + sfx, key, subtract_gradient, im, gradient, amount=self.gradient)
 
         # set black based on automatic blackpoint estimate and lift setting
         # we also allow lift settings in non-auto case
 
-        if self.autoblack and (self._std_background is not None):
-            black = max(0, self._blackpoint - self.lift * self._std_background)
+        if self.autoblack and (st.std_background is not None):
+            black = max(0, st.blackpoint - self.lift * st.std_background)
 
-        elif self._std_background is not None:
-            black = max(0, self.black - self.lift * self._std_background)
+        elif st.std_background is not None:
+            black = max(0, self.black - self.lift * st.std_background)
 
         else:
             black = self.black
 
-        # why not working?
-        if self.autowhite:
-            self.update_whitepoint(im)
-            white = self._whitepoint
+        # why not working?
+        if self.autowhite and region is not None:
+            # keep the full frame estimate rather than one for the region; if there
+            # is none yet, estimate from the region for this render only, leaving
+            # the whitepoint setting alone
+            if st.whitepoint is not None:
+                white = st.whitepoint
+            else:
+                white = stage('whitepoint_region' + sfx, key, whitepoint, im)
+        elif self.autowhite and state is not None:
+            white = st.whitepoint = stage('whitepoint', key, whitepoint, im)
+        elif self.autowhite:
+            white = stage('whitepoint' + sfx, key, self.update_whitepoint, im)
         else:
             white = self.white
 
-        im = (im - black) / (white - black)
-
-        im[im > 1] = 1
-        im[im < 0] = 0
+        key = (key, 'bw', black, white)
+        im = stage('bw' + sfx, key, normalise, im, black=black, white=white)
 
         # timings: hyper:4, log: 7 asinh: 23, tanh: 6, gamma: 12
-        if self._std_background is None:
+        if st.std_background is None:
             bkg = 0
         else:
-            bkg = self.lift * self._std_background
+            bkg = self.lift * st.std_background
 
-        im = Component.get('Stretcher').apply_stretch(
+        stretcher = Component.get('Stretcher')
+        key = (key, 'stretch', stretcher.stretch, stretcher.use_LUT, self.p1, self.noise_reduction, bkg)
+        im = stage('stretch' + sfx, key, stretcher.apply_stretch,
             im,
             param=self.p1,
             NR=self.noise_reduction,
@@ -389,22 +704,30 @@ class Monochrome(Component, JSettings):
         # order of these two is not clear; seem to get fewer ringing
         # artefacts if sharpening is done first
 
-        # apply sharpening
+        # apply sharpening; the blurred image is cached separately so only
+        # the blend is recomputed when just the amount changes
         if self.unsharp_amount > 0 and self.unsharp_radius > 0:
-            im = unsharp_masking(im, radius=self.unsharp_radius, amount=self.unsharp_amount)
+            blurred = stage('unsharp_blur' + sfx, (key, self.unsharp_radius),
+                blur, im, self.unsharp_radius / f, mode='reflect')
+            key = (key, 'unsharp', self.unsharp_radius, self.unsharp_amount)
+            im = stage('unsharp' + sfx, key, unsharp_blend, im, blurred,
+                amount=self.unsharp_amount)
 
-        # apply noise reduction
+        # apply noise reduction, likewise caching the background estimate
         if self.TNR_amount > 0:
-            im = TNR(
-                im, 
-                ksize=self.TNR_kernel_size, 
-                method=self.TNR_method, 
-                param=self.TNR_amount,
-                binfac=int(self.TNR_binning[0]))
-
-        # # apply sharpening
-        # if self.unsharp_amount > 0 and self.unsharp_radius > 0:
-        #     im = unsharp_masking(im, radius=self.unsharp_radius, amount=self.unsharp_amount)
+            bkg = stage('TNR_blur' + sfx,
+                (key, self.TNR_kernel_size, self.TNR_method, self.TNR_binning),
+                blur,
+                im,
+                int(max(1, self.TNR_kernel_size / f)),
+                method=self.TNR_method,
+                binfac=max(1, int(self.TNR_binning[0]) // f))
+            key = (key, 'TNR', self.TNR_kernel_size, self.TNR_method, self.TNR_amount, self.TNR_binning)
+            im = stage('TNR' + sfx, key, TNR_blend, im, bkg, param=self.TNR_amount)
+
+        if state is not None:
+            st.final = (render_key, im)
+        elif f == 1 and region is None:
+            self._final = (render_key, im)
 
         return im
-
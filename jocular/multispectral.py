@@ -3,68 +3,63 @@
 
 import json
 from functools import partial
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 
 import warnings
 warnings.simplefilter('ignore')
 import numpy as np
 
 from scipy.stats import trimboth
-from skimage.color import rgb2lab, lab2rgb
-from skimage.transform import resize, rescale
 from loguru import logger
 
 from kivy.properties import NumericProperty, StringProperty
 from kivy.app import App
+from kivy.clock import Clock
 from kivy.metrics import dp
 from kivy.uix.gridlayout import GridLayout
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.anchorlayout import AnchorLayout
 from kivy.uix.label import Label
 
-from jocular.gradient import estimate_gradient, estimate_background
+from jocular.gradient import (
+    estimate_gradient, estimate_background, bilinear_upsample, ImageCache
+    )
+from jocular.colourspace import rgb_to_lab, lab_to_rgb, chroma
+from jocular.stretcher import apply_lut, lut_size
 from jocular.component import Component
+from jocular.utils import block_mean, check_dtype
 from jocular.settingsmanager import JSettings
 from jocular.widgets.widgets import JMDToggleButton
 from jocular.panel import Panel
 
 
 
-def bin_image(im, binfac=2, rescale_to_orig=True):
-    ''' bin and rescale to original size; 
-        in v0.5 added the preserve range option
-    '''
-    binfac = int(binfac)
-    if binfac == 1:
-        return im
-    if binfac < 1:
-        return im
-    # im2 = rescale(im, 1 / binfac, anti_aliasing=True, mode='constant', 
-    #     preserve_range=True, multichannel=False)
-    im2 = rescale(im, 1 / binfac, anti_aliasing=True, mode='constant', 
-        preserve_range=True)
-    if rescale_to_orig:
-        return resize(im2, im.shape, anti_aliasing=False, mode='constant',
-            preserve_range=True)
-    return im2
-
-
 def _percentile_clip(a, perc=80):
     return np.mean(trimboth(np.sort(a, axis=0), (100 - perc)/100, axis=0), axis=0)
 
 
-def modify_saturation(x, saturation):
+def modify_saturation(x, saturation, out=None):
     # Shift endpoints of labA or B to increase saturation. A/B values cover the
     # range -127- to 128 so we increase slope and then trim to range.
     # sat=1 corresponds to shift of 100 (that's a lot!)
+    # Result is written into out if supplied.
     if saturation <= 0:
         return x
     k = saturation * 100
     mx = np.mean(x)
     # steepen but preserve mean (perhaps should do this after trimming?)
-    x1 = (x - mx) * (255/(255 - 2*k)) + mx 
-    x1[x1 < -127] = -127
-    x1[x1 > 127] = 127
-    return x1
+    x1 = np.subtract(x, mx, out=out)
+    x1 *= 255 / (255 - 2 * k)
+    x1 += mx
+    return np.clip(x1, -127, 127, out=x1)
+
+
+def modgamma(x, g=.5, a0=.01):
+    # gamma stretch with linear segment below a0 to avoid amplifying colour noise
+    s = g / (a0 * (g - 1) + a0 ** (1 - g))
+    d = (1 / (a0 ** g * (g - 1) + 1)) - 1
+    return np.where(x < a0, x * s, (1 + d) * (np.maximum(x, a0) ** g) - d)
 
 
 def modify_hue(x, shift):
@@ -73,6 +68,10 @@ def modify_hue(x, shift):
     return x
 
 
+# colour processing entry points in order; each subsumes those after it
+colour_stages = ['LAB', 'colour_stretch', 'saturation', 'hue', 'RGB']
+
+
 def limitto01(im):
     im[im < 0] = 0
     im[im > 1] = 1
@@ -144,6 +143,19 @@ class MultiSpectral(Panel, Component, JSettings):
 
 
     def __init__(self, **kwargs):
+        self.stack_pool = ThreadPoolExecutor(max_workers=4)
+        self.colour_worker = ThreadPoolExecutor(max_workers=1)
+        self.colour_lock = Lock()  # held by worker while computing a stage
+        self.pending_lock = Lock()
+        self.colour_pending = None  # index of earliest colour stage needing computation
+        self.colour_generation = 0  # incremented on each colour request or reset
+        self.running_generation = 0
+        self.reset_generation = 0  # results from before this generation are invalid
+        self.shown_generation = 0  # generation of the colour image last displayed
+        self.modgamma_luts = {}  # map from modgamma settings to lookup table
+        self.plane_buffers = {}  # map from stage name to reusable float32 planes
+        self.binned_cache = ImageCache(max_cached=6)
+        self.pending_stacks = None  # futures of channel stacks being combined
         super().__init__(**kwargs)
         self.stacker = Component.get('Stacker')
  
@@ -170,6 +182,16 @@ class MultiSpectral(Panel, Component, JSettings):
 
 
     def reset(self):
+        # wait for any colour stage in progress, then cancel the rest
+        with self.colour_lock:
+            with self.pending_lock:
+                self.colour_pending = None
+                self.colour_generation += 1
+                self.reset_generation = self.colour_generation
+            self._reset()
+
+
+    def _reset(self):
         # set these to None to force updates in the colour-generation sequence
         self.lum = None
         self.R = None
@@ -181,9 +203,15 @@ class MultiSpectral(Panel, Component, JSettings):
         self.B_sat = None
         self.A_hue = None
         self.B_hue = None
+        self.chroma = None
         self.RGB = None
         self.layer = None
+        self.layer_range = None
         self.layer_stretched = None
+        self.layer_rgb_lum = {}  # map from proxy factor to luminance in layer RGB buffer
+        self.proxies = {}
+        self.colour_binfac = 1  # binning of colour planes relative to stacks
+        self.pending_stacks = None
         self.r_weight = 1
         self.g_weight = 1
         self.b_weight = 1
@@ -303,38 +331,105 @@ class MultiSpectral(Panel, Component, JSettings):
         return L / np.percentile(L.ravel(), 99.99)
 
 
+    def schedule(self, stage):
+        ''' Coalesce colour updates so each is requested at most once per frame
+        '''
+        later = colour_stages[colour_stages.index(stage) + 1:]
+        Component.get('RenderScheduler').request(stage, self.update_colour, stage, subsumes=later)
+
+
     def on_saturation(self, *args):
-        self.adjust_saturation()
+        self.schedule('saturation')
 
 
     def on_colour_stretch(self, *args):
-        self.adjust_colour_stretch()
+        self.schedule('colour_stretch')
 
     def on_r_weight(self, *args):
-        self.create_LAB()
+        self.schedule('LAB')
 
     def on_g_weight(self, *args):
-        self.create_LAB()
+        self.schedule('LAB')
 
     def on_b_weight(self, *args):
-        self.create_LAB()
+        self.schedule('LAB')
 
 
     # not currently used
     def on_redgreen(self, *args):
-        self.adjust_hue()
+        self.schedule('hue')
 
 
     def on_yellowblue(self, *args):
-        self.adjust_hue()
+        self.schedule('hue')
 
 
     def on_bin_colour(self, *args):
-        self.create_LAB()
+        self.schedule('LAB')
 
 
     def on_subtract_gradients(self, *args):
-        self.create_LAB()
+        self.schedule('LAB')
+
+
+    def update_colour(self, stage):
+        ''' Request computation of the colour pipeline from stage onwards on
+            the colour worker thread; requests made while a computation is in
+            progress are merged and run once it completes, so that results keep
+            being displayed while a control is dragged
+        '''
+        with self.pending_lock:
+            i = colour_stages.index(stage)
+            self.colour_pending = i if self.colour_pending is None else min(i, self.colour_pending)
+            self.colour_generation += 1
+        self.colour_worker.submit(self.run_colour_stages)
+
+
+    def run_colour_stages(self):
+        with self.colour_lock:
+            with self.pending_lock:
+                start, self.colour_pending = self.colour_pending, None
+                self.running_generation = self.colour_generation
+            # already handled by an earlier run
+            if start is None:
+                return
+            try:
+                {
+                    'LAB': self.create_LAB,
+                    'colour_stretch': self.adjust_colour_stretch,
+                    'saturation': self.adjust_saturation,
+                    'hue': self.adjust_hue,
+                    'RGB': self.compose
+                }[colour_stages[start]]()
+            except Exception as e:
+                logger.exception(f'problem in colour pipeline ({e})')
+
+
+    def next_stage(self, stage, fn):
+        ''' Called on the worker to continue with stage (computed by fn) unless
+            the pipeline has been reset in the meantime
+        '''
+        # give main thread a chance to reset between stages
+        self.colour_lock.release()
+        self.colour_lock.acquire()
+        with self.pending_lock:
+            if self.running_generation < self.reset_generation:
+                return
+        fn()
+
+
+    def post_image(self, im, f):
+        ''' Display result of colour pipeline on main thread unless a newer
+            one has been displayed or the pipeline has since been reset
+        '''
+        check_dtype(im, 'colour')
+        Clock.schedule_once(partial(self.display_colour, im, f, self.running_generation), 0)
+
+
+    def display_colour(self, im, f, generation, dt):
+        if generation >= self.reset_generation and generation > self.shown_generation:
+            self.shown_generation = generation
+            Component.get('View').display_image(im, proxy_factor=f)
 
 
     def filters_being_displayed(self):
@@ -418,11 +513,71 @@ class MultiSpectral(Panel, Component, JSettings):
             self.app.gui.set('spectral_mode', mode)
             return
 
+        # get required channels, plus any luminance channel, concurrently
+        needs = list(self.chans[mode]['needs'])
+        if mode in {'RGB', 'HOO', 'SHO', 'HOS'}:
+            lum = 'L' if self.luminance_mode == 'L+synL' else self.luminance_mode
+            if lum != 'synL' and lum not in needs:
+                needs.append(lum)
+        self.fetch_stacks(needs, partial(self.stacks_ready, mode))
+
+
+    def fetch_stacks(self, filts, callback):
+        ''' Combine stacks for filts in parallel (numpy releases the GIL),
+            calling callback with map from filter to stack on the main thread
+            once all are available. Any fetch in progress is superseded and
+            those of its channels not yet started are cancelled.
+        '''
+
+        if self.pending_stacks is not None:
+            for fut in self.pending_stacks.values():
+                fut.cancel()
+        self.pending_stacks = None
+        if len(filts) < 2:
+            callback({f: self.stacker.get_stack(f) for f in filts})
+            return
+
+        futures = {f: self.stack_pool.submit(self.stacker.get_stack, f) for f in filts}
+        self.pending_stacks = futures
+        self.info(f'combining 0/{len(futures)} channels')
+        for fut in futures.values():
+            fut.add_done_callback(lambda fut: Clock.schedule_once(
+                partial(self.stack_fetched, futures, callback), 0))
+
+
+    def stack_fetched(self, futures, callback, dt):
+        # superseded or already delivered
+        if futures is not self.pending_stacks:
+            return
+
+        ndone = len([f for f in futures.values() if f.done()])
+        if ndone < len(futures):
+            self.info(f'combining {ndone}/{len(futures)} channels')
+            return
+
+        self.pending_stacks = None
+        stacks = {}
+        for filt, fut in futures.items():
+            try:
+                stacks[filt] = fut.result()
+            except Exception as e:
+                logger.exception(f'problem combining {filt} stack ({e})')
+                stacks[filt] = None
+        callback(stacks)
+
+
+    def stacks_ready(self, mode, stacks):
+        ''' Complete change of spectral mode once required stacks are combined
+        '''
+
+        # user may have returned to viewing subs in the meantime
+        if not self.stacker.viewing_stack:
+            self.update_info()
+            return
+
         self.reset()
         props = self.chans[mode]
-
-        # get required channels
-        stacks = {c: self.stacker.get_stack(c) for c in props['needs']}
+        stacks = {c: stacks[c] for c in props['needs']}
 
         # if any chans not available, do mono
         notavail = np.any([v is None for v in stacks.values()])
@@ -437,7 +592,7 @@ class MultiSpectral(Panel, Component, JSettings):
             self.B = stacks[mode[2]]
             l = self.get_lum_stack(self.R, self.G, self.B)
             self.lum = Component.get('Monochrome').update_lum(l)
-            self.create_LAB()
+            self.update_colour('LAB')
 
         # view single filter
         elif mode in {'L', 'H', 'O', 'S', 'R', 'G', 'B'}:
@@ -448,10 +603,9 @@ class MultiSpectral(Panel, Component, JSettings):
         elif mode.startswith('L+'):
             other = mode[-1]
             L = stacks['L']
-            layer = stacks[other]
             self.lum = Component.get('Monochrome').update_lum(L)
-            self.layer = layer / np.percentile(layer.ravel(), 99.99)
-            self.layer_stretch_changed()
+            self.layer, self.layer_range = self.prepare_layer(stacks[other])
+            self.update_colour('colour_stretch')
     
         # view in mono
         else:
@@ -467,11 +621,22 @@ class MultiSpectral(Panel, Component, JSettings):
 
     def stack_changed(self):
         ''' Called by Stacker.stack_changed to handle both mono
-            and multispectral cases
+            and multispectral cases; rendering is scheduled so that subs
+            arriving in quick succession only lead to one update per frame,
+            which supersedes any pending luminance or colour updates
         '''
+        Component.get('RenderScheduler').request('stack', self.render_stack,
+            subsumes={'lum', 'sub'} | set(colour_stages))
+
+
+    def render_stack(self):
 
         logger.debug('')
 
+        # user may have returned to viewing subs since the render was requested
+        if not self.stacker.viewing_stack:
+            return
+
         if self.spectral_mode == 'mono':
             L = self.stacker.get_stack(filt='all')
             Component.get('Monochrome').L_changed(L)
@@ -484,22 +649,58 @@ class MultiSpectral(Panel, Component, JSettings):
         colour manipulation; they generally do some specialised
         computation then call the next process in the chain. Done
         like this for efficiency so only those things that need
-        recomputing are
+        recomputing are. They run on the colour worker thread,
+        moving on via next_stage so they can be superseded
     '''
 
+    def prepare_layer(self, stack):
+        ''' Normalised, gradient-corrected narrowband layer and its range,
+            cached per stack version so only the stretch is recomputed when
+            colour_stretch changes
+        '''
+        prepared = self.binned_cache.get(stack, 'layer')
+        if prepared is None:
+            layer = stack / np.percentile(stack.ravel(), 99.99)
+            layer -= estimate_gradient(layer)[0]
+            lo = float(np.min(layer))
+            hi = max(lo + 1e-6, float(np.max(layer)))
+            prepared = self.binned_cache.put(stack, (layer, (lo, hi)), 'layer')
+        return prepared
+
+
     def layer_stretch_changed(self):
         if self.layer is not None:
-            self.layer_stretched = self.modgamma(self.layer - estimate_gradient(self.layer)[0], 
-                g=self.colour_stretch)
-            self.layer_sat_changed()
+            lo, hi = self.layer_range
+            self.layer_stretched = self.modgamma(self.layer, g=self.colour_stretch, lo=lo, hi=hi)
+            self.next_stage('RGB', self.layer_sat_changed)
 
 
     def layer_sat_changed(self):
+        ''' Compose layer (in red) with luminance into a preallocated RGB
+            buffer; luminance is only copied when it changes so saturation
+            changes cost one multiply-add. A copy is posted since the main
+            thread keeps the displayed image while the buffer is rewritten
+        '''
         if self.layer_stretched is not None:
-            r = 3 * self.saturation * self.layer_stretched + self.lum
-            r[r < 0] = 0
-            r[r > 1] = 1            
-            Component.get('View').display_image(np.stack([r, self.lum, self.lum], axis=-1))
+            f = self.proxy_factor()
+            rgb = self.layer_rgb_buffer(f)
+            r = rgb[..., 0]
+            np.multiply(self.proxy(self.layer_stretched, f), 3 * self.saturation, out=r)
+            r += self.lum
+            np.clip(r, 0, 1, out=r)
+            self.post_image(rgb.copy(), f)
+
+
+    def layer_rgb_buffer(self, f):
+        ''' RGB buffer used only by the colour worker, with G and B filled
+            with the current luminance
+        '''
+        rgb = self.buffers(f'layer_rgb@{f}', self.lum.shape + (3,), 1)[0]
+        if self.layer_rgb_lum.get(f) is not self.lum:
+            rgb[..., 1] = self.lum
+            rgb[..., 2] = self.lum
+            self.layer_rgb_lum[f] = self.lum
+        return rgb
 
 
     def luminance_only(self):
@@ -511,24 +712,47 @@ class MultiSpectral(Panel, Component, JSettings):
         # called from monochrome if user updates luminance control e.g. white
 
         self.lum = lum
-        # we are in LRGB mode
-        if self.LAB is not None:
-            self.create_RGB()
-
-        # we are in L+ mode
-        elif self.layer is not None:
-            self.layer_sat_changed()
+        # we are in LRGB or L+ mode
+        if self.R is not None or self.layer is not None:
+            self.update_colour('RGB')
 
         # display as mono
         else:            
-            Component.get('View').display_image(lum)
+            Component.get('View').display_image(lum,
+                proxy_factor=Component.get('Monochrome').lum_factor)
+
+
+    def proxy_factor(self):
+        # downsampling factor of luminance relative to full resolution colour
+        return Component.get('Monochrome').lum_factor if self.lum is not None else 1
+
+
+    def proxy(self, im, f, binfac=1):
+        ''' Version of colour plane im, which is binned by binfac, resampled
+            to the resolution of the luminance, which is downsampled by f;
+            cached so it is computed once per drag or colour change
+        '''
+        if f == binfac:
+            return im
+        key = (id(im), f)
+        if key not in self.proxies:
+            # discard proxies of planes that are no longer current
+            live = {id(x) for x in list(self.chroma or []) + [self.layer_stretched] if x is not None}
+            self.proxies = {k: v for k, v in self.proxies.items() if k[0] in live}
+            if f % binfac == 0:
+                resampled = block_mean(im, binfac=f // binfac)
+            else:
+                resampled = bilinear_upsample(im, self.lum.shape[:2], box=binfac / f)
+            # hold on to source so its id is not reused
+            self.proxies[key] = (im, resampled)
+        return self.proxies[key][1]
 
 
     ''' Colour processes are daisy-chained and intermediate representations cached for speed        
         create_LAB          normed_RGB
         stretch_color       LAB             
         adjust_saturation   A_sat, B_sat
-        adjust_hue          A_hue, B_hue
+        adjust_hue          A_hue, B_hue, chroma
         create_RGB          RGB             <-- entry point for luminosity changes
     '''
 
@@ -547,17 +771,17 @@ class MultiSpectral(Panel, Component, JSettings):
 
         # include color normalisation
 
-        ims = [self.r_weight*self.R, self.g_weight*self.G, self.b_weight*self.B]
-
-        # binning ~ 70 ms
+        # bin (by block mean) gradient-compensated channels, caching the results
+        # per stack version; weights are applied afterwards so weight changes
+        # don't require rebinning, and the rest of the colour pipeline works
+        # at binned resolution, with upsampling at composition (create_RGB)
         binfac = int(self.bin_colour[0])
-        if binfac > 1:
-            ims = [bin_image(im, binfac=binfac) for im in ims]
+        self.colour_binfac = binfac
+        ims = [self.binned_channel(im, binfac) for im in [self.R, self.G, self.B]]
+        ims = [w * im for w, im in zip([self.r_weight, self.g_weight, self.b_weight], ims)]
 
         # compensation prior to scaling
-        if self.compensation == 'subtract gradients':
-            ims = [im - estimate_gradient(im) for im in ims]
-        elif self.compensation == 'subtract background':
+        if self.compensation == 'subtract background':
             ims = [im - estimate_background(im)[0] for im in ims]
 
         ''' the percentile is absolutely critical: setting too low
@@ -587,16 +811,49 @@ class MultiSpectral(Panel, Component, JSettings):
         self.normed_RGB = [limitto01(im) for im in ims]
 
         # rest of process
-        self.adjust_colour_stretch()
+        self.next_stage('colour_stretch', self.adjust_colour_stretch)
+
+
+    def binned_channel(self, im, binfac):
+        ''' Channel stack im binned by binfac, after subtracting its gradient
+            if required; cached per stack version
+        '''
+        params = (binfac, self.compensation)
+        binned = self.binned_cache.get(im, params)
+        if binned is None:
+            if self.compensation == 'subtract gradients':
+                # gradient is smooth so can be subtracted before binning
+                binned = block_mean(im - estimate_gradient(im), binfac=binfac)
+            else:
+                binned = block_mean(im, binfac=binfac)
+            # nothing to cache if unbinned and uncompensated
+            if binned is not im:
+                self.binned_cache.put(im, binned, params)
+        return binned
 
 
-    def modgamma(self, x, g=.5, a0=.01):
-        y = x.copy()
-        s = g / (a0 * (g - 1) + a0 ** (1 - g))
-        d = (1 / (a0 ** g * (g - 1) + 1)) - 1
-        y[x < a0] = x[x < a0] * s
-        y[x >= a0] =  (1 + d) * (x[x >= a0] ** g) - d
-        return y
+    def modgamma(self, x, g=.5, a0=.01, lo=0, hi=1, out=None):
+        ''' Modified gamma via a lookup table over the range lo-hi of x,
+            tabulated once per setting, writing into out if supplied
+        '''
+        key = (g, a0, lo, hi)
+        if key not in self.modgamma_luts:
+            if len(self.modgamma_luts) > 16:
+                self.modgamma_luts = {}
+            xs = np.linspace(lo, hi, lut_size, dtype=np.float32)
+            self.modgamma_luts[key] = modgamma(xs, g=g, a0=a0).astype(np.float32)
+        return apply_lut(x, self.modgamma_luts[key], lo=lo, hi=hi, out=out)
+
+
+    def buffers(self, name, shape, n):
+        ''' Return n preallocated float32 planes of given shape for reuse
+            by stage name
+        '''
+        bufs = self.plane_buffers.get(name)
+        if bufs is None or bufs[0].shape != shape:
+            bufs = [np.empty(shape, dtype=np.float32) for _ in range(n)]
+            self.plane_buffers[name] = bufs
+        return bufs
 
 
     def avail(self, props):
@@ -613,21 +870,24 @@ class MultiSpectral(Panel, Component, JSettings):
 
         elif self.avail('normed_RGB'):
             # use modified gamma correction here to avoid colour noise
-            ims = [self.modgamma(im, g=self.colour_stretch) for im in self.normed_RGB]
-            self.LAB = rgb2lab(np.stack(ims, axis=-1))  # 80ms
-            self.adjust_saturation()
+            bufs = self.buffers('stretched', self.normed_RGB[0].shape, 3)
+            ims = [self.modgamma(im, g=self.colour_stretch, out=buf)
+                for im, buf in zip(self.normed_RGB, bufs)]
+            self.LAB = rgb_to_lab(*ims)
+            self.next_stage('saturation', self.adjust_saturation)
 
 
     def adjust_saturation(self, *args):
         # Modify saturation and call next process
         
         if self.avail('layer'):
-            self.layer_sat_changed()
+            self.next_stage('RGB', self.layer_sat_changed)
 
         elif self.avail('LAB'):
-            self.A_sat = modify_saturation(self.LAB[:, :, 1], self.saturation)
-            self.B_sat = modify_saturation(self.LAB[:, :, 2], self.saturation)
-            self.adjust_hue() # next process in hue adjustment
+            bufs = self.buffers('saturation', self.LAB.shape[:2], 2)
+            self.A_sat = modify_saturation(self.LAB[:, :, 1], self.saturation, out=bufs[0])
+            self.B_sat = modify_saturation(self.LAB[:, :, 2], self.saturation, out=bufs[1])
+            self.next_stage('hue', self.adjust_hue) # next process in hue adjustment
 
 
     def adjust_hue(self, *args):
@@ -636,14 +896,25 @@ class MultiSpectral(Panel, Component, JSettings):
         if self.avail('A_sat'):
             self.A_hue = modify_hue(self.A_sat, self.redgreen)
             self.B_hue = modify_hue(self.B_sat, self.yellowblue)
-            self.create_RGB()  # next process
+            # cache chroma planes so luminance changes need only recombine
+            self.chroma = chroma(self.A_hue, self.B_hue)
+            self.next_stage('RGB', self.create_RGB)  # next process
 
 
     def create_RGB(self):
         ''' Combine L, A and B into RGB image. Called here when previous colour process
         has been applied (hue_changed), or when luminosity component has changed (below)
         '''
-        if self.avail(['lum', 'A_hue']):
-            self.RGB = lab2rgb(np.stack([ 100 * self.lum, self.A_hue, self.B_hue], axis=-1))
-            Component.get('View').display_image(self.RGB)
+        if self.avail(['lum', 'chroma']):
+            f = self.proxy_factor()
+            self.RGB = lab_to_rgb(self.lum, [self.proxy(c, f, binfac=self.colour_binfac) for c in self.chroma])
+            self.post_image(self.RGB, f)
+
+
+    def compose(self):
+        # final stage: combine luminance with colour
+        if self.avail('layer'):
+            self.layer_sat_changed()
+        else:
+            self.create_RGB()
 
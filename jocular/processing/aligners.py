@@ -11,6 +11,8 @@ from skimage.measure import ransac
 from scipy.spatial.distance import cdist
 from skimage.transform import EuclideanTransform, warp, estimate_transform
 
+from jocular.utils import as_image
+
 
 class AlignerException(Exception):
     pass
@@ -55,7 +57,7 @@ def align_ransac(im, keystars, centroids, min_stars=5, min_inliers=4, warp_model
 
         # managed to align, so return warped image
         if (inliers is not None) and (sum(inliers) >= min_inliers):
-            return warp(im, warp_model, order=3, preserve_range=True), warp_model
+            return as_image(warp(im, warp_model, order=3, preserve_range=True)), warp_model
 
     raise AlignerException('not enough inliers after RANSAC')
 
@@ -83,7 +85,7 @@ def align_martin(im, keystars, centroids, min_stars=10):
         raise AlignerException('not enough stars to align ({:} but need {:})'.format(len(src), min_stars))
 
     warp_model = estimate_transform('euclidean', src, dst)
-    return warp(im, warp_model, order=3, preserve_range=True), warp_model
+    return as_image(warp(im, warp_model, order=3, preserve_range=True)), warp_model
     
 
 def fastmatch(
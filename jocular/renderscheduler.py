@@ -0,0 +1,75 @@
+''' Coalesces requests to update the display so that at most one render
+    per request type takes place per frame, using the latest parameters.
+'''
+
+import time
+from collections import deque
+from functools import partial
+import numpy as np
+from loguru import logger
+
+from kivy.clock import Clock
+
+from jocular.component import Component
+
+
+class RenderScheduler(Component):
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.trigger = Clock.create_trigger(self.render)
+        self.pending = {}       # map from request type to (fn, subsumed request types)
+        self.frame_times = deque(maxlen=100)  # seconds per render, most recent last
+        self.reset_stats()
+
+
+    def on_new_object(self):
+        self.pending = {}
+        self.reset_stats()
+
+
+    def reset_stats(self):
+        self.n_requests = 0
+        self.n_dropped = 0
+        self.frame_times.clear()
+
+
+    def request(self, name, fn, *args, subsumes=None):
+        ''' Mark pipeline as dirty. A later request of the same type replaces
+            any pending one (and takes its place in arrival order), and when
+            rendering, a request is dropped if a request of a type that subsumes
+            it arrived later and so will do the work anyway
+        '''
+        if self.pending.pop(name, None) is not None:
+            self.n_dropped += 1
+        self.pending[name] = (partial(fn, *args), set({}) if subsumes is None else set(subsumes))
+        self.n_requests += 1
+        self.trigger()
+
+
+    def render(self, *args):
+        pending, self.pending = self.pending, {}
+        if len(pending) == 0:
+            return
+
+        # working back from the latest request, drop those subsumed by later ones
+        subsumed, todo = set(), []
+        for name, (fn, subsumes) in reversed(pending.items()):
+            if name in subsumed:
+                self.n_dropped += 1
+                continue
+            subsumed |= subsumes
+            todo.append((name, fn))
+
+        t0 = time.perf_counter()
+        for name, fn in reversed(todo):
+            try:
+                fn()
+            except Exception as e:
+                logger.exception(f'problem rendering {name} ({e})')
+        self.frame_times.append(time.perf_counter() - t0)
+
+        # frame time statistics for the status panel
+        ft = 1000 * np.array(self.frame_times)
+        self.info(f'{np.mean(ft):.0f} ms/frame (max {np.max(ft):.0f}) | {self.n_dropped}/{self.n_requests} dropped')
+
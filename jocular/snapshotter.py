@@ -53,7 +53,8 @@ class Snapshotter(Panel, Component, JSettings):
         'png': 'save as a .png format file',
         'jpg': 'save as a .jpg format file',
         'fits': 'save as a 16-bit FITs format file',
-        'animated gif': 'save whole sequence of images as an animated gif'
+        'animated gif': 'save whole sequence of images as an animated gif',
+        'animated mp4': 'save whole sequence of images as an mp4 video (needs ffmpeg)'
     }
 
     imreduction = NumericProperty(1.8)
@@ -200,6 +201,8 @@ class Snapshotter(Panel, Component, JSettings):
         try:
             if self.save_format == 'animated gif':
                 Component.get('Stacker').make_animated_gif()
+            elif self.save_format == 'animated mp4':
+                Component.get('Stacker').make_animation(fmt='mp4')
             else:
                 self.snap()
         except:
@@ -214,6 +217,9 @@ class Snapshotter(Panel, Component, JSettings):
         if not hasattr(view, 'last_image') or (view.last_image is None):
             return
 
+        # if only the eyepiece region has been processed, compute the rest
+        view.render_full_frame()
+
         dso = Component.get('DSO')
 
         self.save_path = '{:} {:}.{:}'.format(
@@ -416,7 +422,8 @@ class Snapshotter(Panel, Component, JSettings):
 
         # v0.5: ensure tmp is in snapshots dir now that user can start from anywhere
         nm = os.path.join(self.app.get_path('snapshots'), '_tmp.png')
-        im = Component.get('View').last_image.copy()
+        view = Component.get('View')
+        im = view.do_flips(view.last_image).copy()
         try:
             imsave(nm, im[::-1])
             orig_im = Image.open(nm)
@@ -4,6 +4,7 @@
 
 import numpy as np
 from functools import partial
+from threading import Lock
 from loguru import logger
 
 from kivy.app import App
@@ -14,7 +15,7 @@ from kivy.properties import StringProperty
 
 from jocular.component import Component
 from jocular.widgets.widgets import JMDToggleButton
-from jocular.utils import percentile_clip
+from jocular.utils import percentile_clip, as_image, check_dtype
 from jocular.panel import Panel
 
 
@@ -26,6 +27,7 @@ class StackCombiner(Panel, Component):
         super().__init__(**kwargs)
         self.app = App.get_running_app()
         self.methods = ['mean', '90', '80', '70', 'median']
+        self.filter_locks = {}  # map from filter to lock guarding its cached stack
         self.build()
         self.panel_opacity = 0
 
@@ -78,6 +80,13 @@ class StackCombiner(Panel, Component):
 
 
     def combine(self, stk, orig_sub_map, filt='all', calibration=False):
+        # stacks may be combined concurrently (see MultiSpectral.fetch_stacks)
+        # so each filter's cache entry is read and updated under its own lock
+        with self.filter_locks.setdefault(filt, Lock()):
+            return self.combine_filter(stk, orig_sub_map, filt=filt, calibration=calibration)
+
+
+    def combine_filter(self, stk, orig_sub_map, filt='all', calibration=False):
 
         logger.trace(f'combining stack for filt {filt}')
 
@@ -116,8 +125,11 @@ class StackCombiner(Panel, Component):
                         # drop thru to recombination
                     else:
                         stacked = (cached['stack'] * ncache + c_op * orig_sub_map[dsub].get_image()) / (ncache + c_op)
-                        self.stack_cache[filt]['stack'] = stacked
-                        self.stack_cache[filt]['sub_names'] = sub_names
+                        self.stack_cache[filt] = {
+                            'stack': stacked,
+                            'method': method,
+                            'sub_names': sub_names
+                            }
                         return stacked
 
         # if not, we need to update
@@ -147,5 +159,5 @@ def combine_stack(subs, method='mean'):
         s = np.median(stk, axis=0)
     else: 
         s = percentile_clip(stk, perc=int(method))
-    return s
+    return as_image(check_dtype(s, f'{method} combination'))
 
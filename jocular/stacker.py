@@ -23,6 +23,7 @@ from jocular.settingsmanager import JSettings
 from jocular.utils import s_to_minsec, move_to_dir, purify_name, toast
 from jocular.image import Image, fits_in_dir
 from jocular.widgets.widgets import JSlider
+from jocular.animation import to_frame, save_animation, ffmpeg_path
 
 from kivy.lang import Builder
 
@@ -58,9 +59,11 @@ class Stacker(Component, JSettings):
     subs = ListProperty([])
     animating = BooleanProperty(False)
     speed = NumericProperty(2)
+    animation_max_size = 1024   # largest dimension of animation frames
     confirm_before_deleting_stack = BooleanProperty(True)
     reload_rejected = BooleanProperty(False)
     calibrate_first = BooleanProperty(False)
+    keep_raw_subs = BooleanProperty(False)
 
     configurables = [
         ('confirm_before_deleting_stack', {
@@ -74,6 +77,11 @@ class Stacker(Component, JSettings):
             'name': 'calibrate before bad pixel removal',
             'switch': '',
             'help': 'original approach is to do bad pixel removal first'
+            }),
+        ('keep_raw_subs', {
+            'name': 'fast recalibration',
+            'switch': '',
+            'help': 'keep uncalibrated subs in memory (doubling memory use) so that new or changed masters can be applied without reloading'
             })
         ]
 
@@ -474,35 +482,60 @@ class Stacker(Component, JSettings):
             self.selected_sub += 1
 
 
-    def get_screen(self, dt=None):
-        im = Component.get('Snapshotter').snap(return_image=True).copy()
-        self.ims.append(im.convert('L'))
-        if len(self.ims) < len(self.subs):
-            self.selected_sub += 1
-            Clock.schedule_once(self.get_screen, 0)
-        else:
-            save_path = '{:} {:}.gif'.format(
-                    os.path.join(self.app.get_path('snapshots'), 
-                        purify_name(Component.get('DSO').Name)), 
-                    datetime.now().strftime('%d%b%y_%H_%M_%S'))
-            self.ims[0].save(save_path, 
-                save_all=True, 
-                append_images=self.ims[1:], 
-                optimize=True, 
-                # include_color_table=False,
-                duration=1000 / self.speed, 
-                loop=0)
-            # Component.get('Snapshotter').info('saved animation')
-            toast(f'saved animation to {save_path}', duration=2)
+    def make_animated_gif(self):
+        self.make_animation(fmt='gif')
 
 
-    def make_animated_gif(self):
-        # stop existing animation
-        if hasattr(self, 'play_event'):
-            Clock.unschedule(self.play_event)
-        self.ims = []
-        self.selected_sub = 0
-        Clock.schedule_once(self.get_screen, 0)
+    def make_animation(self, fmt='gif'):
+        ''' Render subs offscreen with the current display settings and encode
+            them in the background as an animated gif or (if ffmpeg is available)
+            an mp4, so the display is not tied up while saving
+        '''
+        if self.is_empty():
+            return
+        if fmt == 'mp4' and ffmpeg_path() is None:
+            toast('ffmpeg not found so saving as animated gif', duration=2)
+            fmt = 'gif'
+        view = Component.get('View')
+        display = {'invert': view.invert, 'flip_UD': view.flip_UD, 'flip_LR': view.flip_LR}
+        subs = list(self.subs)
+        first = next((im for im in (s.get_image() for s in subs) if im is not None), None)
+        if first is None:
+            toast('no sub images available to animate', duration=2)
+            return
+        shape = first.shape[:2]
+        binfac = math.ceil(max(shape) / self.animation_max_size)
+        save_path = '{:} {:}.{:}'.format(
+                os.path.join(self.app.get_path('snapshots'),
+                    purify_name(Component.get('DSO').Name)),
+                datetime.now().strftime('%d%b%y_%H_%M_%S'),
+                fmt)
+        toast(f'rendering {len(subs)} frames in the background', duration=2)
+        save_animation(self.animation_frames(subs, shape, binfac, display), save_path,
+            fmt=fmt, fps=self.speed, on_done=self.animation_saved)
+
+
+    def animation_frames(self, subs, shape, binfac, display):
+        # generator of frames, rendered as the encoder requests them
+        mono = Component.get('Monochrome')
+        for sub in subs:
+            im = sub.get_image()
+            if im is None or im.shape[:2] != shape:
+                continue
+            lum = mono.offscreen_luminance(im, do_gradient=sub.sub_type == 'light')
+            yield to_frame(lum, binfac=binfac, **display)
+
+
+    def animation_saved(self, future):
+        # called from encoding thread so report on main thread
+        try:
+            mesg = f'saved animation to {future.result()}'
+        except ValueError as e:
+            mesg = f'animation not saved: {e}'
+        except Exception as e:
+            logger.exception(f'problem saving animation ({e})')
+            mesg = 'problem saving animation'
+        Clock.schedule_once(lambda dt: toast(mesg, duration=2), 0)
 
 
     def sub_added(self):
@@ -529,11 +562,21 @@ class Stacker(Component, JSettings):
                 ss.get_image(), 
                 do_gradient=ss.sub_type=='light',
                 fwhm=ss.fwhm if hasattr(ss, 'fwhm') else 0)
+            self.prefetch_neighbours()
 
         self.update_stack_scroller()
         self.check_for_change()
 
 
+    def prefetch_neighbours(self):
+        ''' Prepare light subs either side of the selected sub in the background,
+            wrapping around as animation does
+        '''
+        n, s = len(self.subs), self.selected_sub
+        nbrs = [self.subs[i] for i in sorted({(s + 1) % n, (s - 1) % n} - {s})]
+        Component.get('Monochrome').prefetch([ss for ss in nbrs if ss.sub_type == 'light'])
+
+
     def get_current_displayed_image(self, first_sub=False):
         ''' Called by platesolver to get currently displayed image
              which might be short sub, sub, or stack
@@ -737,6 +780,32 @@ class Stacker(Component, JSettings):
     #     self.reprocess_event = Clock.schedule_once(self._reprocess_sub, 0)
 
 
+    def recalibrate(self, *args):
+        ''' Reapply calibration to light subs from their stored raw images,
+            followed by each sub's existing alignment warp, rather than
+            reloading, removing bad pixels and realigning as in recompute
+        '''
+
+        if self.is_empty() or any(s.sub_type != 'light' for s in self.subs):
+            return
+
+        # a recompute in progress will pick up the changes anyway
+        if getattr(self, 'reprocess_event', None) is not None:
+            return
+
+        # bad pixel removal follows calibration so can't be reused
+        if self.calibrate_first or any(getattr(s, 'raw_image', None) is None for s in self.subs):
+            self.recompute()
+            return
+
+        Component.get('Calibrator').calibrate_batch(self.subs)
+        aligner = Component.get('Aligner')
+        for s in self.subs:
+            aligner.apply_warp(s)
+        Component.get('StackCombiner').reset()
+        self.stack_changed()
+
+
     def _reprocess_sub(self, dt):
         if self.selected_sub + 1 < len(self.subs):
             self.process(self.subs[self.selected_sub + 1])
@@ -759,6 +828,8 @@ class Stacker(Component, JSettings):
         if not self.calibrate_first:
             Component.get('BadPixelMap').process_bpm(sub)
         if sub.sub_type == 'light':
+            # copy since calibration leaves the image as is when no masters apply
+            sub.raw_image = sub.get_image().copy() if self.keep_raw_subs else None
             Component.get('Calibrator').calibrate(sub)
             if self.calibrate_first:
                 Component.get('BadPixelMap').process_bpm(sub)
@@ -65,7 +65,7 @@ class Status(MDBoxLayout, Component):
     show_status = BooleanProperty(False)
     comps = [
         'Capture', 'Calibrator', 'View', 'Aligner', 
-        'PlateSolver', 'Monochrome', 'MultiSpectral', 'Stacker']
+        'PlateSolver', 'Monochrome', 'MultiSpectral', 'Stacker', 'RenderScheduler']
 
 
     def __init__(self, **kwargs):
@@ -15,16 +15,36 @@ from kivy.app import App
 from kivy.metrics import dp
 from kivy.uix.gridlayout import GridLayout
 from kivy.uix.anchorlayout import AnchorLayout
-from kivy.properties import StringProperty
+from kivy.properties import StringProperty, BooleanProperty
 
 from jocular.component import Component
+from jocular.settingsmanager import JSettings
 from jocular.widgets.widgets import JMDToggleButton
 from jocular.panel import Panel
 
+# number of entries in stretch lookup table (ie 16-bit quantisation of input)
+lut_size = 2 ** 16
 
-class Stretcher(Panel, Component):
+# stretches that depend only on pixel value and so can be applied via a LUT
+pointwise_stretches = {
+    'linear', 'sublin', 'gamma', 'log', 'asinh', 'hyper',
+    'sigmoid', 'gamma2', 'log2', 'ilog'}
+
+
+class Stretcher(Panel, Component, JSettings):
 
     stretch = StringProperty('asinh')
+    use_LUT = BooleanProperty(True)
+
+    tab_name = 'Stretch'
+
+    configurables = [
+        ('use_LUT', {
+            'name': 'use lookup table?',
+            'switch': '',
+            'help': 'faster stretching via a 16-bit lookup table (has no effect on histeq, clahe and rank)'
+            }),
+        ]
 
 
     def __init__(self, **kwargs):
@@ -36,6 +56,7 @@ class Stretcher(Panel, Component):
         #     'sublin', 'linear', 'hyper', 'log', 'gamma', 'asinh', 
         #     'hyper', 'histeq', 'clahe', 'rank',
         #     'gamma2', 'log2', 'ilog', 'sigmoid']
+        self.lut = (None, None)  # (key, table), replaced as a whole as stretch may be threaded
         self.build()
         self.panel_opacity = 0
 
@@ -78,15 +99,54 @@ class Stretcher(Panel, Component):
         ''' apply stretch, called in monochrome
         '''
 
-        # if no noise reduction just use stretch alone
-        if (NR <= 0) or (background is None):
-            return stretch_main(x, method=self.stretch, param=param)
+        if not self.use_LUT or self.stretch not in pointwise_stretches:
+            return stretch_NR(x, method=self.stretch, param=param, NR=NR, background=background)
+
+        # only rebuild table when parameters change
+        key = (self.stretch, param, NR, background is None)
+        lut_key, lut = self.lut
+        if key != lut_key:
+            lut = build_lut(method=self.stretch, param=param, NR=NR, background=background)
+            self.lut = (key, lut)
+        return apply_lut(x, lut)
+
+
+def stretch_NR(x, method='linear', param=None, NR=1, background=None):
+    ''' Stretch with optional noise reduction
+    '''
 
-        # get stretched data and lightly suppress low end
-        y = stretch_main(x, method=self.stretch, param=param)
-        # y = y / np.max(y)
-        hyper_param = 1 - .1 * (NR / 100)
-        return y * stretch_main(x, method='hyper', param=hyper_param)
+    # if no noise reduction just use stretch alone
+    if (NR <= 0) or (background is None):
+        return stretch_main(x, method=method, param=param)
+
+    # get stretched data and lightly suppress low end
+    y = stretch_main(x, method=method, param=param)
+    # y = y / np.max(y)
+    hyper_param = 1 - .1 * (NR / 100)
+    return y * stretch_main(x, method='hyper', param=hyper_param)
+
+
+def build_lut(method='linear', param=None, NR=1, background=None):
+    ''' Tabulate stretch (which must be pointwise) over 0-1
+    '''
+    x = np.linspace(0, 1, lut_size, dtype=np.float32)
+    return np.asarray(stretch_NR(x, method=method, param=param, NR=NR, background=background),
+        dtype=np.float32)
+
+
+def apply_lut(x, lut, lo=0, hi=1, out=None):
+    ''' Quantise x (in range lo-hi, by default 0-1) to index into lut,
+        optionally writing the result into out
+    '''
+    scale = np.float32((len(lut) - 1) / (hi - lo))
+    if lo == 0:
+        inds = x * scale
+    else:
+        inds = np.subtract(x, np.float32(lo), dtype=np.float32)
+        inds *= scale
+    inds += .5
+    np.clip(inds, 0, len(lut) - 1, out=inds)
+    return np.take(lut, inds.astype(np.uint16), out=out)
 
 
 def stretch_main(x, method='linear', param=None):
@@ -155,3 +155,49 @@ def move_to_dir(frompath, topath):
         logger.exception(f'problem moving {frompath} to {topath} ({e})')
 
 
+def block_mean(im, binfac=2):
+    ''' Downsample 2D (or 2D x channels) image by averaging over
+        binfac x binfac blocks, trimming any remainder
+    '''
+    binfac = int(binfac)
+    if binfac <= 1:
+        return im
+    h, w = im.shape[0] // binfac, im.shape[1] // binfac
+    im = im[:h * binfac, :w * binfac]
+    return im.reshape((h, binfac, w, binfac) + im.shape[2:]).mean(axis=(1, 3), dtype=np.float32)
+
+
+# dtype policy: images are float32 from camera readout through to display;
+# when checking is on (see View settings), stages producing other float
+# types are reported
+image_dtype = np.float32
+_check_dtypes = False
+_dtype_reported = set()
+
+
+def set_dtype_checking(on=True):
+    global _check_dtypes
+    _check_dtypes = on
+    _dtype_reported.clear()
+
+
+def as_image(im):
+    ''' Return im as float32, without copying if it already is
+    '''
+    return np.asarray(im, dtype=image_dtype)
+
+
+def from_adu(pix, bits=16):
+    ''' Scale raw integer camera data to float32 in range 0-1
+    '''
+    return np.multiply(pix, 1 / 2 ** bits, dtype=image_dtype)
+
+
+def check_dtype(im, stage):
+    ''' Report (once per stage) if im is a float array wider than float32
+    '''
+    if _check_dtypes and isinstance(im, np.ndarray) and im.dtype.kind == 'f' \
+        and im.dtype.itemsize > 4 and stage not in _dtype_reported:
+        _dtype_reported.add(stage)
+        logger.warning(f'{stage} produced {im.dtype} image of shape {im.shape}')
+    return im
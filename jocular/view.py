@@ -2,25 +2,28 @@
     ScatterView class
 '''
 
+import math
 import os
 import time
 import numpy as np
 from loguru import logger
 
 from kivy.app import App
+from kivy.clock import Clock
 from kivy.graphics.texture import Texture
 from kivy.graphics.transformation import Matrix
 from kivy.properties import (
     BooleanProperty, NumericProperty, 
-    BoundedNumericProperty, ListProperty
+    BoundedNumericProperty, ListProperty, StringProperty
     )
 from kivy.core.window import Window
 
-from jocular.utils import toast
+from jocular.utils import toast, block_mean, set_dtype_checking, check_dtype
 from jocular.component import Component
 from jocular.settingsmanager import JSettings
 from jocular.metrics import Metrics
 from jocular.widgets.scatterview import ScatterView
+from jocular.widgets.tiledimage import TiledImage
 
 
 class View(Component, JSettings):  # must be in this order
@@ -39,6 +42,16 @@ class View(Component, JSettings):  # must be in this order
     max_zoom = NumericProperty(30)
     zoom_power = NumericProperty(1)
     continuous_update = BooleanProperty(True)
+    dragging = BooleanProperty(False)
+    tiled_display = StringProperty('auto')
+    check_dtypes = BooleanProperty(False)
+    processing_region = StringProperty('full frame')
+    max_proxy_factor = 8
+    region_margin = .1          # fraction of eyepiece radius processed beyond its edge
+    region_align = 32           # so that proxies of the region tile those of the full frame
+    tile_size = 1024
+    max_texture_size = 4096     # conservative limit for integrated graphics
+    max_tile_level = 3          # coarsest pyramid level (1/8 size) for tiles
 
 
     configurables = [
@@ -65,16 +78,44 @@ class View(Component, JSettings):  # must be in this order
         ('zoom_power', {
             'name': 'zoom power', 'float': (.5, 2, .1),
             'fmt': 'zoom ^ {:.2f}',
-            'help': 'apply a power curve to provide more sensitivity'})
+            'help': 'apply a power curve to provide more sensitivity'}),
+        ('tiled_display', {
+            'name': 'tiled display',
+            'options': ['auto', 'on', 'off'],
+            'help': 'split image into tiles, only updating those that change (auto: for very large images)'}),
+        ('processing_region', {
+            'name': 'processing region',
+            'options': ['full frame', 'eyepiece'],
+            'help': 'eyepiece: when zoomed in, only process the part of the image visible in the eyepiece'}),
+        ('check_dtypes', {
+            'name': 'report float64 images?',
+            'switch': '',
+            'help': 'For debugging: log processing stages that produce float64 rather than float32 images'})
         ]
 
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.cached_image = None
+        self.cached_proxy_factor = 1
+        self.display_buffer = None  # preallocated uint8 image passed to texture
+        self.scratch_buffer = None  # and float32 workspace used to fill it
+        self.display_source = None  # image last converted into display buffer
+        self.full_frame_image = None    # last full frame image displayed
+        self.region_canvases = {}   # map from proxy factor to full frame image holding regions
+        self.displayed_region = None
+        self.full_frame_requested = False
+        self.proxy_shown = False
         self.last_image_time = 0
         self.app = App.get_running_app()        
         self.scatter = ScatterView(self)
+        self.tiled_image = TiledImage(tile_size=self.tile_size)
+        self.scatter.add_widget(self.tiled_image)
+        self.tiling = False
+        self.tile_trigger = Clock.create_trigger(self.refresh_tiles)
+        self.scatter.bind(transform=self.tile_trigger)
+        self.region_trigger = Clock.create_trigger(self.check_region, .1)
+        self.scatter.bind(transform=self.region_trigger)
         self.app.gui.add_widget(self.scatter, index=100)
         self.scatter._set_center((0, 0))
         self.ring_selected = False
@@ -104,6 +145,9 @@ class View(Component, JSettings):  # must be in this order
         self.ROI = None
         self.pre_ROI_image = None   # stored so we can undo ROI
         self.last_image = None
+        self.full_frame_image = None
+        self.region_canvases = {}
+        self.displayed_region = None
         self.reset_texture()
         self.update_state()
 
@@ -135,6 +179,134 @@ class View(Component, JSettings):  # must be in this order
         Component.get('Annotator').update()
 
 
+    def proxy_factor(self):
+        ''' While a control is being dragged, return the largest power of 2
+            by which the image can be downsampled without dropping below
+            screen resolution at the current zoom; otherwise 1
+        '''
+        if not self.dragging or self.scatter.scale >= .5:
+            return 1
+        f = 2 ** int(math.log2(1 / self.scatter.scale))
+        return min(f, self.max_proxy_factor)
+
+
+    def on_dragging(self, *args):
+        # once control is released, render proxy at full resolution
+        if not self.dragging and self.proxy_shown:
+            self.proxy_shown = False
+            Component.get('Monochrome').adjust_lum()
+
+
+    def use_tiles(self, w, h):
+        return self.tiled_display == 'on' or \
+            (self.tiled_display == 'auto' and max(w, h) > self.max_texture_size)
+
+
+    def on_tiled_display(self, *args):
+        if getattr(self, 'last_image', None) is not None:
+            self.reset_texture(w=self.w, h=self.h, colorfmt=self.colorfmt)
+            self.display_image(use_cached_image=True)
+
+
+    def on_check_dtypes(self, *args):
+        set_dtype_checking(self.check_dtypes)
+
+
+    def tile_level(self, pos, size):
+        ''' Pyramid level for a tile at pos (in image coords) with given size:
+            coarsest if the tile is outside the eyepiece, otherwise the finest
+            level that doesn't exceed screen resolution at the current zoom
+        '''
+        x, y = pos
+        w, h = size
+        corners = [self.scatter.to_parent(cx, cy) for cx, cy in
+            [(x, y), (x + w, y), (x, y + h), (x + w, y + h)]]
+        xs, ys = [c[0] for c in corners], [c[1] for c in corners]
+        xc, yc = Metrics.get('origin')
+        r = Metrics.get('inner_radius')
+        if min(xs) > xc + r or max(xs) < xc - r or min(ys) > yc + r or max(ys) < yc - r:
+            return self.max_tile_level
+        if self.scatter.scale >= .5:
+            return 0
+        return min(self.max_tile_level, int(math.log2(1 / self.scatter.scale)))
+
+
+    def refresh_tiles(self, *args):
+        ''' Zoom or pan may change the required level of some tiles
+        '''
+        if self.tiling and getattr(self, 'last_image', None) is not None:
+            self.tiled_image.update(self.last_image, self.tile_level,
+                proxy_factor=self.cached_proxy_factor, check_data=False)
+
+
+    def eyepiece_region(self, shape, margin=None):
+        ''' Bounding box (y0, y1, x0, x1) in image pixels of the eyepiece plus
+            a margin, aligned so that proxies of the region match those of the
+            full frame. Returns None (ie process the full frame) if region
+            processing is off, no full frame monochrome image of this shape has
+            yet been displayed, or the box covers most of the image
+        '''
+        h, w = shape[0], shape[1]
+        if self.processing_region != 'eyepiece' or self.full_frame_requested or \
+            self.full_frame_image is None or self.full_frame_image.shape != (h, w):
+            return None
+
+        xc, yc = Metrics.get('origin')
+        r = Metrics.get('inner_radius')
+        r *= 1 + (self.region_margin if margin is None else margin)
+        xcp, ycp = self.scatter.to_local(xc, yc)
+        xep, yep = self.scatter.to_local(xc - r, yc)
+        rp = ((xcp - xep) ** 2 + (ycp - yep) ** 2) ** 0.5
+        if self.flip_LR:
+            xcp = w - xcp
+        if self.flip_UD:
+            ycp = h - ycp
+
+        a = self.region_align
+        x0, y0 = max(0, int((xcp - rp) // a) * a), max(0, int((ycp - rp) // a) * a)
+        x1, y1 = min(w, int(math.ceil((xcp + rp) / a)) * a), min(h, int(math.ceil((ycp + rp) / a)) * a)
+        if x1 <= x0 or y1 <= y0 or (x1 - x0) * (y1 - y0) > w * h / 2:
+            return None
+        return y0, y1, x0, x1
+
+
+    def check_region(self, *args):
+        ''' After a pan or zoom, rerender if the eyepiece now shows parts of
+            the image outside the processed region (or the full frame is needed)
+        '''
+        if self.displayed_region is None or self.full_frame_image is None:
+            return
+        needed = self.eyepiece_region(self.full_frame_image.shape, margin=0)
+        y0, y1, x0, x1 = self.displayed_region
+        if needed is None or needed[0] < y0 or needed[1] > y1 or needed[2] < x0 or needed[3] > x1:
+            Component.get('Monochrome').adjust_lum()
+
+
+    def render_full_frame(self):
+        ''' Ensure the full frame is processed and displayed, e.g. before a snapshot
+        '''
+        if self.displayed_region is not None:
+            self.full_frame_requested = True
+            try:
+                Component.get('Monochrome').render_lum()
+            finally:
+                self.full_frame_requested = False
+
+
+    def region_canvas(self, im, region, proxy_factor):
+        ''' Insert processed region im into a full frame image at the given
+            proxy scale, initialised from the last full frame image displayed
+        '''
+        f = proxy_factor
+        canvas = self.region_canvases.get(f)
+        if canvas is None:
+            canvas = block_mean(self.full_frame_image, f) if f > 1 else self.full_frame_image.copy()
+            self.region_canvases[f] = canvas
+        y0, x0 = region[0] // f, region[2] // f
+        canvas[y0: y0 + im.shape[0], x0: x0 + im.shape[1]] = im
+        return canvas
+
+
     def lever_to_zoom(self, z):
         return self.min_zoom + (z ** self.zoom_power) *(self.max_zoom - self.min_zoom)
 
@@ -268,18 +440,26 @@ class View(Component, JSettings):  # must be in this order
 
 
     def on_flip_LR(self, *args):
-        self.display_image(use_cached_image=True)
+        if getattr(self, 'last_image', None) is not None:
+            self.apply_flips()
         self.update_state()
 
 
     def on_flip_UD(self, *args):
-        self.display_image(use_cached_image=True)
+        if getattr(self, 'last_image', None) is not None:
+            self.apply_flips()
         self.update_state()
 
  
     def reset_texture(self, w=10, h=10, colorfmt='luminance'):
-        self.scatter.ids.image.size = w, h
-        self.scatter.ids.image.texture = Texture.create(size=(w, h), colorfmt=colorfmt)
+        image = self.scatter.ids.image
+        image.size = w, h
+        # when tiling, image widget only provides the geometry
+        self.tiling = self.use_tiles(w, h)
+        image.texture = Texture.create(size=(1, 1) if self.tiling else (w, h), colorfmt=colorfmt)
+        image.opacity = 0 if self.tiling else 1
+        self.tiled_image.reset(*((w, h) if self.tiling else (0, 0)), colorfmt=colorfmt)
+        self.tiled_image.set_flips(self.flip_LR, self.flip_UD)
         self.scatter._set_center(Metrics.get('origin'))
         self.w, self.h = w, h
         self.colorfmt = colorfmt
@@ -291,7 +471,7 @@ class View(Component, JSettings):  # must be in this order
 
 
     def do_flips(self, im):
-        # perform flips (< 1 ms)
+        # perform flips (< 1 ms); display uses texture coords instead (see apply_flips)
         if self.flip_UD:
             im = im[::-1]
         if self.flip_LR:
@@ -299,10 +479,49 @@ class View(Component, JSettings):  # must be in this order
         return im
 
 
-    def display_image(self, im=None, use_cached_image=False):
+    def apply_flips(self):
+        ''' Flip displayed image via texture coordinates rather than copying it
+        '''
+        if self.tiling:
+            self.tiled_image.set_flips(self.flip_LR, self.flip_UD)
+            return
+        image = self.scatter.ids.image
+        image.texture.uvpos = (1 if self.flip_LR else 0, 1 if self.flip_UD else 0)
+        image.texture.uvsize = (-1 if self.flip_LR else 1, -1 if self.flip_UD else 1)
+        # force image to pick up new texture coords
+        image.property('texture').dispatch(image)
+
+
+    def to_display_buffer(self, im, invert=False, region=None):
+        ''' Convert im (range 0-1) to uint8 with clipping and optional inversion,
+            writing into a preallocated contiguous buffer which is returned. If
+            only region (y0, y1, x0, x1) of im has changed since it was last
+            converted, only that part is converted
+        '''
+        if self.display_buffer is None or self.display_buffer.shape != im.shape:
+            self.display_buffer = np.empty(im.shape, dtype=np.uint8)
+            self.scratch_buffer = np.empty(im.shape, dtype=np.float32)
+            region = None
+        if im is not self.display_source:
+            region = None
+        self.display_source = im
+        y0, y1, x0, x1 = (0, None, 0, None) if region is None else region
+        buf = self.scratch_buffer[y0: y1, x0: x1]
+        np.multiply(im[y0: y1, x0: x1], -255 if invert else 255, out=buf, casting='unsafe')
+        if invert:
+            buf += 255
+        np.clip(buf, 0, 255, out=buf)
+        np.copyto(self.display_buffer[y0: y1, x0: x1], buf, casting='unsafe')
+        return self.display_buffer
+
+
+    def display_image(self, im=None, use_cached_image=False, proxy_factor=1, region=None):
         ''' Called with an image, in which case update cached image, perform flips etc
         and display; or without an image, in which case use cached image and perform
-        flips/invert directly on that.
+        flips/invert directly on that. A proxy_factor > 1 indicates that the image is
+        downsampled by that factor and is displayed at the size of the full image.
+        If region (y0, y1, x0, x1 in full frame pixels) is given, im only covers
+        that part of the frame (see eyepiece_region).
         '''
 
         if (im is None) and (not use_cached_image):
@@ -311,37 +530,65 @@ class View(Component, JSettings):  # must be in this order
         if use_cached_image and (self.cached_image is None):
             return
 
+        changed = None
         if im is not None:
+            check_dtype(im, 'display')
+            self.displayed_region = region
+            if region is not None:
+                im = self.region_canvas(im, region, proxy_factor)
+                changed = [v // proxy_factor for v in region]
+            else:
+                self.region_canvases = {}
+                if proxy_factor == 1:
+                    self.full_frame_image = im
             self.cached_image = im
+            self.cached_proxy_factor = proxy_factor
 
         if use_cached_image:
             im = self.cached_image  # just for shorthand below
+            proxy_factor = self.cached_proxy_factor
 
         # we now have a cached image
         colorfmt = 'luminance' if im.ndim == 2 else 'rgb'
 
         # check if shape or color has changed
         h, w = im.shape[0], im.shape[1]
-        if (w != self.w) or (h != self.h) or (colorfmt != self.colorfmt):
+        if proxy_factor > 1 and self.tiling:
+            # tiles handle proxies themselves
+            self.proxy_shown = True
+            if colorfmt != self.colorfmt:
+                self.reset_texture(w=self.w, h=self.h, colorfmt=colorfmt)
+        elif proxy_factor > 1:
+            # keep display size of full image but with a texture for the proxy
+            self.proxy_shown = True
+            if colorfmt != self.colorfmt:
+                self.reset_texture(w=self.w, h=self.h, colorfmt=colorfmt)
+            texture = self.scatter.ids.image.texture
+            if tuple(texture.size) != (w, h):
+                self.scatter.ids.image.texture = Texture.create(size=(w, h), colorfmt=colorfmt)
+        elif (w != self.w) or (h != self.h) or (colorfmt != self.colorfmt):
             old_center = self.scatter._get_center()
             self.reset_texture(w=w, h=h, colorfmt=colorfmt)
             self.scatter._set_center(old_center)
-
-        im = self.do_flips(im)
-
-        # only invert if luminance and not RGB image
-        if self.invert and colorfmt == 'luminance':
-            im = np.subtract(1, im, dtype=im.dtype)
-
-        self.last_image = np.uint8(im * 255)
-        self.scatter.ids.image.texture.blit_buffer(
-            self.last_image.flatten(), 
-            colorfmt=colorfmt, 
-            bufferfmt='ubyte')
+        elif not self.tiling and tuple(self.scatter.ids.image.texture.size) != (w, h):
+            # returning from proxy
+            self.scatter.ids.image.texture = Texture.create(size=(w, h), colorfmt=colorfmt)
+
+        # only invert if luminance and not RGB image; NB last_image is unflipped
+        self.last_image = self.to_display_buffer(im,
+            invert=self.invert and colorfmt == 'luminance', region=changed)
+        if self.tiling:
+            self.tiled_image.update(self.last_image, self.tile_level, proxy_factor=proxy_factor)
+        else:
+            self.scatter.ids.image.texture.blit_buffer(
+                self.last_image.ravel(),
+                colorfmt=colorfmt,
+                bufferfmt='ubyte')
+            self.apply_flips()
 
         # first time through for each object, apply settings
         if hasattr(self, 'orientation_settings') and self.orientation_settings is not None:
-            z = self.zoom_to_lever(Window.height / self.last_image.shape[0])
+            z = self.zoom_to_lever(Window.height / self.h)
             App.get_running_app().gui.set('zoom', z)
             self.zoom = z
             if 'orientation' in self.orientation_settings:
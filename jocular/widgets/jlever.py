@@ -27,6 +27,7 @@ class JLever(JRotWidget, Label):
 
     value = NumericProperty(0.0)
     disabled = BooleanProperty(False)
+    selected = BooleanProperty(False)
 
 
     def __init__(self, value=0, values=None, angles=None, radial=True,
@@ -40,7 +41,6 @@ class JLever(JRotWidget, Label):
         self.min_angle, self.max_angle = angles[0], angles[1]
         self.min_value, self.max_value = values[0], values[1]
         self.value = value
-        self.selected = False
 
         # disabled this because can't get View on init reliably it seems
         # if continuous_update is None:
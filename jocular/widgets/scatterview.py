@@ -19,6 +19,7 @@ Builder.load_string('''
     do_scale: True
     Image:
         id: image
+        allow_stretch: True
 ''')
 
 
@@ -0,0 +1,113 @@
+''' Displays a large image as a grid of textures
+'''
+
+import numpy as np
+
+from kivy.uix.widget import Widget
+from kivy.graphics import Color, Rectangle
+from kivy.graphics.texture import Texture
+
+from jocular.utils import block_mean
+
+
+class TiledImage(Widget):
+    ''' Image split into fixed-size tiles each with its own texture, so that
+        no texture exceeds GPU limits, only tiles whose pixels have changed
+        are uploaded, and each tile can be uploaded at its own pyramid level
+    '''
+
+    def __init__(self, tile_size=1024, **kwargs):
+        super().__init__(**kwargs)
+        self.tile_size = tile_size
+        self.tiles = {}
+        self.colorfmt = 'luminance'
+        self.flip_LR = False
+        self.flip_UD = False
+        self.n_uploads = 0
+
+
+    def reset(self, w=0, h=0, colorfmt='luminance'):
+        ''' Set up tiles to cover an image of w x h pixels
+        '''
+        self.canvas.clear()
+        self.tiles = {}
+        self.size = w, h
+        self.colorfmt = colorfmt
+        ts = self.tile_size
+        with self.canvas:
+            Color(1, 1, 1, 1)
+            for y0 in range(0, h, ts):
+                for x0 in range(0, w, ts):
+                    x1, y1 = min(w, x0 + ts), min(h, y0 + ts)
+                    self.tiles[(y0, x0)] = {
+                        'bounds': (x0, x1, y0, y1),
+                        'rect': Rectangle(size=(x1 - x0, y1 - y0)),
+                        'texture': None,
+                        'binfac': None,
+                        'data': None
+                    }
+        self.position_tiles()
+
+
+    def set_flips(self, flip_LR=False, flip_UD=False):
+        self.flip_LR, self.flip_UD = flip_LR, flip_UD
+        self.position_tiles()
+
+
+    def position_tiles(self):
+        ''' Place tiles (and flip their textures) to give the flipped image
+        '''
+        w, h = self.size
+        for tile in self.tiles.values():
+            x0, x1, y0, y1 = tile['bounds']
+            x = w - x1 if self.flip_LR else x0
+            y = h - y1 if self.flip_UD else y0
+            tile['rect'].pos = self.x + x, self.y + y
+            if tile['texture'] is not None:
+                self.flip_texture(tile)
+
+
+    def flip_texture(self, tile):
+        tex = tile['texture']
+        tex.uvpos = (1 if self.flip_LR else 0, 1 if self.flip_UD else 0)
+        tex.uvsize = (-1 if self.flip_LR else 1, -1 if self.flip_UD else 1)
+        # reassign so rectangle picks up new texture coords
+        tile['rect'].texture = tex
+
+
+    def update(self, im, level_for, proxy_factor=1, check_data=True):
+        ''' Upload uint8 image im to those tiles whose pixels or pyramid level
+            have changed. level_for(pos, size) gives the pyramid level for a tile
+            placed at pos with given size, and proxy_factor is the factor by
+            which im is already downsampled. If check_data is False, only tiles
+            whose level has changed are uploaded.
+        '''
+        f = proxy_factor
+        for tile in self.tiles.values():
+            x0, x1, y0, y1 = tile['bounds']
+            binfac = max(f, 2 ** level_for(tile['rect'].pos, tile['rect'].size))
+            if not check_data and tile['binfac'] == binfac:
+                continue
+            data = im[y0 // f: max(y0 // f + 1, y1 // f), x0 // f: max(x0 // f + 1, x1 // f)]
+            if data.size == 0:
+                continue
+
+            # further downsample if tile level is coarser than that of im
+            extra = min(binfac // f, data.shape[0], data.shape[1])
+            if extra > 1:
+                data = block_mean(data, binfac=extra).astype(np.uint8)
+
+            if tile['binfac'] == binfac and tile['data'] is not None and \
+                np.array_equal(tile['data'], data):
+                continue
+
+            # take a copy since im is reused for successive frames
+            data = np.ascontiguousarray(data) if extra > 1 else data.copy()
+            th, tw = data.shape[0], data.shape[1]
+            if tile['texture'] is None or tuple(tile['texture'].size) != (tw, th):
+                tile['texture'] = Texture.create(size=(tw, th), colorfmt=self.colorfmt)
+            tile['texture'].blit_buffer(data.ravel(), colorfmt=self.colorfmt, bufferfmt='ubyte')
+            self.flip_texture(tile)
+            tile['data'] = data
+            tile['binfac'] = binfac
+            self.n_uploads += 1
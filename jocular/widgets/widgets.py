@@ -315,11 +315,19 @@ class JMDIconButton(MDIconButton, Rotatable):
 
 class JSlider(MDSlider):
 
+    dragging = BooleanProperty(False)
+
     def on_touch_down(self, touch):
         ''' Ensure touch isn't passed thru to scatter
         '''
         if self.collide_point(*touch.pos):
             super().on_touch_down(touch)
+            self.dragging = True
             return True
         return False
 
+    def on_touch_up(self, touch):
+        if self.dragging:
+            self.dragging = False
+        return super().on_touch_up(touch)
+
@@ -0,0 +1,39 @@
+''' Regression checks for luminance processing against the original
+    skimage implementations
+'''
+
+import numpy as np
+import pytest
+from skimage import filters
+from skimage.transform import downscale_local_mean, rescale, resize
+
+from jocular.monochrome import blur, TNR_blend
+
+
+def original_TNR(im, ksize=20, param=1, binfac=1):
+    # TNR as it was before blur/TNR_blend were split out (gaussian method)
+    im2 = downscale_local_mean(im, (binfac, binfac)) if binfac > 1 else im.copy()
+    bkg = filters.gaussian(im2, ksize / binfac)
+    if binfac > 1:
+        h, w = im.shape
+        bh, bw = bkg.shape
+        if bh * binfac == h and bw * binfac == w:
+            bkg = rescale(bkg, (binfac, binfac))
+        else:
+            bkg = resize(bkg, im.shape)
+    return ((im - bkg) / (1 + np.exp(param) * np.exp(-27 * im))) + bkg
+
+
+def smooth_image(shape):
+    y, x = np.mgrid[:shape[0], :shape[1]]
+    noise = np.random.default_rng(0).random(shape)
+    return (.2 + .3 * np.sin(x / 40) * np.cos(y / 30) ** 2 + .05 * noise).astype(np.float32)
+
+
+@pytest.mark.parametrize('shape', [(400, 600), (401, 599)])
+@pytest.mark.parametrize('binfac', [1, 2, 3, 4])
+def test_TNR_matches_original(shape, binfac):
+    im = smooth_image(shape)
+    out = TNR_blend(im, blur(im, 20, binfac=binfac), param=1)
+    assert out.dtype == np.float32
+    assert np.max(np.abs(out - original_TNR(im, 20, binfac=binfac))) < .01